@@ -0,0 +1,223 @@
+'''
+Benchmark de wmZk_index com pastas de notas sintéticas (ver vault.py).
+
+Para cada tamanho de pasta, mede:
+- rebuild: update_index, update_links e update_all com rebuild = True
+  (índice vazio a cada repetição);
+- noop: as mesmas funções sem nenhuma nota alterada;
+- delta: as mesmas funções depois de uma pequena sessão de trabalho
+  (1% das notas modificadas, uma criada e uma apagada);
+- lookup: as funções do plugin (wmZk.get_*, busca e ordenação por
+  relevância) usadas pelos comandos (lista de notas, tags, notas por tag,
+  backlinks, título, busca), sem cache.
+
+Resultados são gravados em JSON (`--output`), com commit e versão de
+Python, e podem ser comparados com um resultado anterior (`--compare`).
+
+    python bench/bench_index.py --sizes 1000 10000 --output depois.json --compare antes.json
+'''
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import platform
+import tempfile
+import types
+import subprocess
+import contextlib
+from statistics import median
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import wmZk_index
+import vault
+
+
+class SublimeStub(types.ModuleType):
+    '''
+    Módulo no lugar das APIs do Sublime Text (`sublime`, `sublime_plugin`
+    e o pacote Citer), para importar o plugin fora do editor: qualquer
+    atributo é uma classe vazia
+    '''
+    def __getattr__(self, name):
+        return type(name, (object,), {})
+
+
+def import_plugin():
+    for name in ("sublime", "sublime_plugin", "Citer"):
+        sys.modules.setdefault(name, SublimeStub(name))
+    import wmZk
+    return wmZk
+
+
+def timed(function, *args, **kwargs):
+    '''
+    Executa `function` (sem mostrar o que ela imprime) e retorna o tempo
+    em segundos
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        return time.perf_counter() - start
+
+
+def summary(notes, scenario, operation, times):
+    return {"notes": notes, "scenario": scenario, "operation": operation, "repeats": len(times),
+            "min": min(times), "median": median(times), "times": times}
+
+
+def prepare_vault(workdir, notes, seed):
+    '''
+    Gera (ou reaproveita, se já gerada com a mesma semente) pasta de notas
+    com `notes` notas. Retorna o caminho da pasta.
+    '''
+    folder = os.path.join(workdir, "vault_%d_%d" % (notes, seed))
+    marker = os.path.join(folder, ".bench_complete")
+    if not os.path.exists(marker):
+        vault.generate(folder, notes, seed)
+        open(marker, "w").close()
+    return folder
+
+
+def fresh_folder(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+
+def update_operations(storage, workers):
+    return [
+        ("update_index", lambda notes, index, rebuild: wmZk_index.update_index(
+            notes, index, rebuild, True, storage, workers)),
+        ("update_links", lambda notes, index, rebuild: wmZk_index.update_links(
+            notes, index, rebuild, storage, workers)),
+        ("update_all", lambda notes, index, rebuild: wmZk_index.update_all(
+            notes, index, rebuild, storage, workers)),
+    ]
+
+
+def lookup_operations(notes_folder, index_folder, storage):
+    '''
+    Funções do plugin chamadas pelos comandos, com argumentos típicos
+    (tag mais usada, nota mais linkada, nota mais recente). Cada operação
+    começa com o cache do plugin vazio.
+    '''
+    wmZk = import_plugin()
+    wmZk.NOTES_FOLDER = notes_folder
+    wmZk.INDEX_FOLDER = index_folder
+    wmZk.STORAGE = storage
+    index = wmZk_index.read_stored_index(index_folder, storage)
+    top_tag = max(index.tags, key=lambda tag: len(index.tags[tag]))
+    last_id = index.recent_rows(1)[1][0]
+    targets = wmZk_index.read_stored_links(index_folder, storage).targets
+    top_target = max(targets, key=lambda target: len(targets[target]))
+
+    def uncached(function, *args):
+        def operation():
+            wmZk.INDEX_CACHE.clear()
+            return function(*args)
+        return operation
+
+    def search(query):
+        groups = wmZk_index.parse_query(query)
+        return wmZk.rank_notes(index_folder, wmZk.query_notes(index_folder, groups),
+                               wmZk_index.query_terms(groups), 200)
+    return [
+        ("get_note_list", uncached(wmZk.get_note_list, index_folder)),
+        ("get_tag_counts", uncached(wmZk.get_tag_counts, index_folder)),
+        ("get_notes_by_tag", uncached(wmZk.get_notes_by_tag, index_folder, top_tag)),
+        ("get_notes_by_link", uncached(wmZk.get_notes_by_link, index_folder, top_target)),
+        ("get_note_title", uncached(wmZk.get_note_title_by_id, index_folder, last_id)),
+        ("search_word", uncached(search, "redes")),
+        ("search_prefix", uncached(search, "desig mercado")),
+        ("search_phrase", uncached(search, '"efeito causal"')),
+    ]
+
+
+def run(sizes, repeats, workdir, seed=0, storage="csv", workers=1, delta_share=0.01):
+    results = []
+    for notes in sizes:
+        print("%d notas: gerando pasta..." % notes, file=sys.stderr)
+        notes_folder = prepare_vault(workdir, notes, seed)
+        # o cenário delta altera as notas: trabalha numa cópia
+        work_folder = os.path.join(workdir, "work_%d" % notes)
+        shutil.rmtree(work_folder, ignore_errors=True)
+        shutil.copytree(notes_folder, work_folder)
+        index_folder = os.path.join(workdir, "index_%d" % notes)
+        for operation, function in update_operations(storage, workers):
+            print("%d notas: %s" % (notes, operation), file=sys.stderr)
+            times = [timed(function, work_folder, fresh_folder(index_folder), True) for i in range(repeats)]
+            results.append(summary(notes, "rebuild", operation, times))
+            times = [timed(function, work_folder, index_folder, False) for i in range(repeats)]
+            results.append(summary(notes, "noop", operation, times))
+            times = []
+            for i in range(repeats):
+                vault.apply_delta(work_folder, max(1, int(notes * delta_share)), seed=len(results) * 100 + i)
+                times.append(timed(function, work_folder, index_folder, False))
+            results.append(summary(notes, "delta", operation, times))
+        print("%d notas: lookups" % notes, file=sys.stderr)
+        for operation, function in lookup_operations(work_folder, index_folder, storage):
+            times = [timed(function) for i in range(repeats)]
+            results.append(summary(notes, "lookup", operation, times))
+    return results
+
+
+def git_commit():
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.decode("utf8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    '''
+    Imprime tabela com tempos (mediana) atuais, anteriores e razão entre eles
+    '''
+    previous = dict(((row["notes"], row["scenario"], row["operation"]), row["median"])
+                    for row in baseline["results"])
+    print("%8s %-8s %-15s %10s %10s %7s" % ("notas", "cenário", "operação", "antes", "depois", "razão"))
+    for row in results:
+        before = previous.get((row["notes"], row["scenario"], row["operation"]))
+        if before is None:
+            continue
+        print("%8d %-8s %-15s %10.4f %10.4f %6.2fx" % (row["notes"], row["scenario"], row["operation"],
+                                                      before, row["median"], row["median"] / before))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark de wmZk_index com pastas de notas sintéticas")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storage", default="csv", choices=["csv", "sqlite", "shards"])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "wmzk_bench"),
+                        help="pasta para as notas geradas (reaproveitadas entre execuções)")
+    parser.add_argument("--output", help="arquivo JSON com resultados (default: stdout)")
+    parser.add_argument("--compare", help="arquivo JSON de uma execução anterior")
+    args = parser.parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+    results = run(args.sizes, args.repeats, args.workdir, args.seed, args.storage, args.workers)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "storage": args.storage,
+        "workers": args.workers,
+        "seed": args.seed,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as file:
+            json.dump(report, file, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    if args.compare:
+        with open(args.compare, encoding="utf8") as file:
+            compare(results, json.load(file))
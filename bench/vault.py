@@ -0,0 +1,172 @@
+'''
+Gera pastas de notas sintéticas (reprodutíveis, a partir de uma semente)
+para medir o desempenho de wmZk_index.
+
+Cada nota tem front matter como o dos templates do plugin (id, título e
+tags, em formatos variados), texto com vocabulário de frequência
+desigual, tags no corpo, links `[[id]]` (as notas mais linkadas recebem
+a maior parte dos links) e citações `@citekey` para notas de fichamento.
+Parte das notas tem imagens em `anexos/`.
+'''
+import os
+import time
+import random
+import shutil
+
+
+# Proporção de notas de fichamento (id = citekey)
+BIBLIO_SHARE = 0.05
+# Proporção de notas com imagem anexada
+ATTACHMENT_SHARE = 0.1
+# Proporção de notas em subpastas
+SUBFOLDER_SHARE = 0.05
+
+WORDS = ("de a o que e do da em um para com não uma os no se na por mais as dos como mas ao ele das "
+         "à seu sua ou quando muito nos já eu também só pelo pela até isso ela entre depois sem mesmo "
+         "aos seus quem nas me esse eles você essa num nem suas meu às minha numa pelos elas qual "
+         "rede redes social sociais dados modelo modelos teoria método pesquisa análise estudo "
+         "resultado efeito causal inferência amostra variável regressão tempo família trabalho "
+         "educação desigualdade mercado política estado instituição cultura gênero idade coorte "
+         "fertilidade casamento divórcio migração renda ocupação classe mobilidade escola").split()
+
+
+def zipf_weights(n, exponent=1.1):
+    '''
+    Pesos cumulativos (para `random.choices`) com probabilidade decrescente
+    com a posição: os primeiros itens são escolhidos com muito mais frequência
+    '''
+    weights = []
+    total = 0.0
+    for rank in range(1, n + 1):
+        total += 1.0 / (rank ** exponent)
+        weights.append(total)
+    return weights
+
+
+WORD_WEIGHTS = zipf_weights(len(WORDS))
+
+
+def make_ids(rnd, n):
+    '''
+    Ids no formato do plugin (AAAAMMDDhhmm), em ordem cronológica
+    '''
+    moment = time.mktime((2015, 1, 1, 8, 0, 0, 0, 0, -1))
+    ids = []
+    for i in range(n):
+        moment += 60 * rnd.randint(1, 600)
+        ids.append(time.strftime("%Y%m%d%H%M", time.localtime(moment)))
+    return ids
+
+
+def make_front_matter(rnd, id, title, tags):
+    '''
+    Front matter em um dos formatos aceitos pelo plugin
+    '''
+    style = rnd.random()
+    if style < 0.5:
+        tag_field = "tags: " + " ".join(tags)
+    elif style < 0.8:
+        tag_field = "tags: [%s]" % ", ".join(tags)
+    else:
+        tag_field = "tags:\n" + "".join("  - %s\n" % tag for tag in tags)
+        tag_field = tag_field.rstrip("\n")
+    return '---\nid: %s\ntitle: "%s"\n%s\n---\n' % (id, title, tag_field)
+
+
+def make_text(rnd, words):
+    return " ".join(rnd.choices(WORDS, cum_weights=WORD_WEIGHTS, k=words))
+
+
+def generate(folder, n, seed=0):
+    '''
+    Cria pasta `folder` com `n` notas sintéticas, geradas a partir de `seed`
+    (a mesma semente sempre gera as mesmas notas, com o mesmo conteúdo).
+    Retorna lista de ids das notas.
+    '''
+    rnd = random.Random(seed)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(os.path.join(folder, "anexos"))
+    ids = make_ids(rnd, n)
+    n_biblio = max(1, int(n * BIBLIO_SHARE))
+    authors = ["silva", "souza", "santos", "oliveira", "pereira", "smith", "jones", "brown", "lee", "garcia"]
+    # citekeys no formato do Better BibTeX (autor + ano + sufixo único)
+    citekeys = ["%s%d%s" % (rnd.choice(authors), rnd.randint(1980, 2020), "abcdefgh"[i % 8] + str(i // 8))
+                for i in range(n_biblio)]
+    citekey_weights = zipf_weights(len(citekeys))
+    n_tags = max(5, int(n ** 0.5) * 2)
+    tag_pool = ["#tag%d" % i for i in range(n_tags)] + ["#rascunho"]
+    tag_weights = zipf_weights(len(tag_pool))
+    subfolders = ["projeto%d" % i for i in range(5)]
+    for position, id in enumerate(ids):
+        if position < n_biblio:
+            # notas de fichamento: id é a citekey
+            id = citekeys[position]
+            tags = ["#fichamentos"]
+        else:
+            tags = sorted(set(rnd.choices(tag_pool, cum_weights=tag_weights, k=rnd.randint(0, 4))))
+        title = make_text(rnd, rnd.randint(2, 8)).capitalize()
+        paragraphs = []
+        for i in range(rnd.randint(1, 6)):
+            words = make_text(rnd, rnd.randint(20, 120)).split()
+            # links para notas anteriores, com preferência pelas mais linkadas
+            for j in range(rnd.randint(0, 3)):
+                if position > n_biblio:
+                    target = ids[n_biblio + int((position - n_biblio) * rnd.random() ** 3)]
+                    words.insert(rnd.randint(0, len(words)), "[[%s]]" % target)
+            if rnd.random() < 0.3:
+                citekey = rnd.choices(citekeys, cum_weights=citekey_weights)[0]
+                words.insert(rnd.randint(0, len(words)), "@" + citekey)
+            if rnd.random() < 0.2:
+                tag = rnd.choices(tag_pool, cum_weights=tag_weights)[0]
+                words.insert(rnd.randint(0, len(words)), tag)
+            paragraphs.append(" ".join(words) + ".")
+        if rnd.random() < ATTACHMENT_SHARE:
+            image = "%s_img1.png" % id
+            with open(os.path.join(folder, "anexos", image), "wb") as file:
+                file.write(b"\x89PNG\r\n\x1a\n" + b"\0" * 256)
+            paragraphs.append("![](anexos/%s)" % image)
+        contents = (make_front_matter(rnd, id, title, tags) + "\n" + "\n\n".join(paragraphs) +
+                    "\n\n---\n## Contexto\n")
+        relative = id + ".md"
+        if rnd.random() < SUBFOLDER_SHARE:
+            relative = os.path.join(rnd.choice(subfolders), relative)
+            os.makedirs(os.path.join(folder, os.path.dirname(relative)), exist_ok=True)
+        with open(os.path.join(folder, relative), "w", encoding="utf8", newline="\n") as file:
+            file.write(contents)
+    return citekeys + ids[n_biblio:]
+
+
+def apply_delta(folder, count, seed=0):
+    '''
+    Simula uma sessão de trabalho em `folder`: modifica `count` notas
+    (acrescenta texto e um link), cria uma nota nova e apaga a criada
+    pela sessão anterior (de mesma pasta). Retorna caminhos alterados.
+    '''
+    rnd = random.Random(seed)
+    notes = sorted(name for name in os.listdir(folder) if name.endswith(".md") and not name.startswith("0"))
+    changed = []
+    for name in rnd.sample(notes, min(count, len(notes))):
+        path = os.path.join(folder, name)
+        with open(path, "a", encoding="utf8", newline="\n") as file:
+            file.write("\n%s [[%s]]\n" % (make_text(rnd, 30), rnd.choice(notes)[:-3]))
+        changed.append(path)
+    for name in os.listdir(folder):
+        if name.startswith("0") and name.endswith(".md"):
+            os.remove(os.path.join(folder, name))
+            changed.append(os.path.join(folder, name))
+    id = "0%011d" % seed
+    path = os.path.join(folder, id + ".md")
+    with open(path, "w", encoding="utf8", newline="\n") as file:
+        file.write(make_front_matter(rnd, id, "Nota nova", ["#rascunho"]) + "\n" + make_text(rnd, 80) + "\n")
+    changed.append(path)
+    return changed
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Gera pasta de notas sintética para benchmarks")
+    parser.add_argument("folder")
+    parser.add_argument("notes", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.folder, args.notes, args.seed)
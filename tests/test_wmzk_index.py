@@ -0,0 +1,76 @@
+'''
+Testes dos parsers de wmZk_index: front matter e elementos das notas.
+
+    python -m unittest discover tests
+'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wmZk_index
+
+
+def header(text, file="/notas/201901131249.md"):
+    return wmZk_index.parse_header(wmZk_index.read_front_matter(text.splitlines(True)), file)
+
+
+class FrontMatterTest(unittest.TestCase):
+    def test_quoted_title(self):
+        id, title, tags = header('---\nid: 201901131249\ntitle: "Redes: um estudo"\n---\ntexto\n')
+        self.assertEqual(id, "201901131249")
+        self.assertEqual(title, "Redes: um estudo")
+        self.assertEqual(header("---\ntitle: 'Aspas simples'\n---\n")[1], "Aspas simples")
+
+    def test_inline_list(self):
+        meta = wmZk_index.read_front_matter(['---\n', 'tags: [#metodo, "#redes", \'#a\']\n', '---\n'])
+        self.assertEqual(meta["tags"], ["#metodo", "#redes", "#a"])
+        self.assertEqual(header('---\ntags: [#metodo, "#redes"]\n---\n')[2], ["#metodo", "#redes"])
+
+    def test_multiline_list(self):
+        text = "---\nid: 1\ntags:\n  - #metodo\n  - \"#redes\"\ntitle: Depois da lista\n---\n"
+        id, title, tags = header(text)
+        self.assertEqual(tags, ["#metodo", "#redes"])
+        self.assertEqual(title, "Depois da lista")
+
+    def test_tags_separated_by_spaces_and_commas(self):
+        self.assertEqual(header("---\ntags: #a #b,#c, #d\n---\n")[2], ["#a", "#b", "#c", "#d"])
+        self.assertEqual(header("---\ntitle: sem tags\n---\n")[2], [])
+
+    def test_no_delimiter(self):
+        # como a extensão Meta do python-markdown: termina na primeira linha em branco
+        meta = wmZk_index.read_front_matter(["id: 42\n", "title: Sem traços\n", "\n", "tags: #corpo\n"])
+        self.assertEqual(meta, {"id": "42", "title": "Sem traços"})
+
+    def test_stops_at_closing_delimiter(self):
+        meta = wmZk_index.read_front_matter(["---\n", "id: 1\n", "...\n", "title: corpo\n"])
+        self.assertEqual(meta, {"id": "1"})
+
+    def test_missing_id_uses_file_name(self):
+        self.assertEqual(header("---\ntitle: x\n---\n", "/notas/sub/201902010900.md")[0], "201902010900")
+
+    def test_keys_lowercase_and_bom(self):
+        meta = wmZk_index.read_front_matter(["\ufeff---\n", "Title: Maiúsculas\n", "---\n"])
+        self.assertEqual(meta, {"title": "Maiúsculas"})
+
+
+class TokenizeTest(unittest.TestCase):
+    def test_offsets_cover_value(self):
+        text = "# Titulo\nver [[201901131249]] e @silva2019, #metodo ![fig](anexos/a.png)\n"
+        for token in wmZk_index.tokenize(text):
+            self.assertEqual(text[token.start:token.end], token.value)
+        self.assertEqual([token.kind for token in wmZk_index.tokenize(text)],
+                         ["heading", "link", "citekey", "tag", "image"])
+
+    def test_tags_and_links(self):
+        text = "#bb #aa [[201901131249]] @silva2019 [[201902010900]] `#nao` #aa"
+        self.assertEqual(wmZk_index.find_tags_and_links(text, "201902010900"),
+                         (["#aa", "#bb"], ["201901131249", "silva2019"]))
+
+    def test_ignores_code_and_urls(self):
+        text = "```\n#nao\n```\n`#nao` http://x.org/#nao #sim\n"
+        self.assertEqual([token.value for token in wmZk_index.tokenize(text)], ["#sim"])
+
+
+if __name__ == "__main__":
+    unittest.main()
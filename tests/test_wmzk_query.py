@@ -0,0 +1,142 @@
+'''
+Testes da pesquisa de notas: consultas (parse_query) e execução com os
+índices (QueryPlan).
+
+    python -m unittest discover tests
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wmZk_index
+from wmZk_index import Predicate
+
+
+class QueryTest(unittest.TestCase):
+    def test_terms_and_phrases(self):
+        self.assertEqual(wmZk_index.parse_query('redes "efeito causal"'),
+                         [[Predicate("text", "redes", False), Predicate("text", "efeito causal", False)]])
+
+    def test_fields(self):
+        groups = wmZk_index.parse_query("tag:metodo link:[[201901131249]] cites:@silva2019 title:\"Redes Sociais\"")
+        self.assertEqual(groups, [[Predicate("tag", "#metodo", False),
+                                   Predicate("link", "201901131249", False),
+                                   Predicate("cites", "silva2019", False),
+                                   Predicate("title", "redes sociais", False)]])
+
+    def test_bare_tags_and_citekeys(self):
+        self.assertEqual(wmZk_index.parse_query("#metodo -@silva2019"),
+                         [[Predicate("tag", "#metodo", False), Predicate("cites", "silva2019", True)]])
+        # fora do formato de tag ou citekey: checado literalmente nos arquivos
+        self.assertEqual(wmZk_index.parse_query("#a"), [[Predicate("regex", r"\#a", False)]])
+
+    def test_negation(self):
+        self.assertEqual(wmZk_index.parse_query("redes -rascunho -tag:#draft"),
+                         [[Predicate("text", "redes", False), Predicate("text", "rascunho", True),
+                           Predicate("tag", "#draft", True)]])
+        # hífen sozinho não é exclusão
+        self.assertEqual(wmZk_index.parse_query("-")[0][0].negated, False)
+
+    def test_or(self):
+        groups = wmZk_index.parse_query("a b OR c OR")
+        self.assertEqual([[predicate.value for predicate in group] for group in groups], [["a", "b"], ["c"]])
+        # "or" em minúsculas é termo de busca
+        self.assertEqual(len(wmZk_index.parse_query("a or b")), 1)
+
+    def test_regex_keeps_backslashes(self):
+        self.assertEqual(wmZk_index.parse_query(r"efe.*causal\s+x"),
+                         [[Predicate("regex", r"efe.*causal\s+x", False)]])
+
+    def test_date_ranges(self):
+        parse = lambda text: wmZk_index.parse_query(text)[0][0].value
+        self.assertEqual(parse("date:2019..202003"), ("2019", "202003"))
+        self.assertEqual(parse("date:2019.."), ("2019", ""))
+        self.assertEqual(parse("date:..2019"), ("", "2019"))
+        self.assertEqual(parse("date:2019"), ("2019", "2019"))
+        in_range = wmZk_index.in_date_range
+        self.assertTrue(in_range("201905011200", ("2019", "2019")))
+        self.assertTrue(in_range("202003311200", ("2019", "202003")))
+        self.assertFalse(in_range("202004011200", ("2019", "202003")))
+        self.assertTrue(in_range("202004011200", ("2019", "")))
+        self.assertFalse(in_range("201812311200", ("2019", "")))
+        # notas de fichamento (id é citekey) não têm data
+        self.assertFalse(in_range("silva2019", ("", "")))
+
+    def test_unbalanced_quotes(self):
+        with self.assertRaises(ValueError):
+            wmZk_index.parse_query('"efeito causal')
+
+
+class QueryPlanTest(unittest.TestCase):
+    NOTES = {
+        "201901131249": "---\ntitle: Redes sociais\ntags: #metodo #redes\n---\nredes e causalidade [[201902010900]]\n",
+        "201902010900": "---\ntitle: Efeito causal\ntags: #metodo #rascunho\n---\nefeito causal em redes @silva2019\n",
+        "202003050800": "---\ntitle: Outra nota\n---\nsobre mercados [[201901131249]]\n",
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        for id, text in cls.NOTES.items():
+            with open(os.path.join(cls.folder, id + ".md"), "w", encoding="utf8") as file:
+                file.write(text.replace("---\n", "---\nid: %s\n" % id, 1))
+        with redirect_stdout(StringIO()):
+            wmZk_index.update_all(cls.folder, cls.folder, True, workers=1)
+        backlinks = wmZk_index.read_backlinks(cls.folder)
+        cls.plan = wmZk_index.QueryPlan(wmZk_index.read_index(cls.folder),
+                                        wmZk_index.read_search_index(cls.folder),
+                                        lambda id: [source for source, title in backlinks.get(id, [])],
+                                        wmZk_index.note_paths(cls.folder, cls.folder))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def run_query(self, text):
+        return sorted(self.plan.run(wmZk_index.parse_query(text)))
+
+    def test_text_and_tag(self):
+        self.assertEqual(self.run_query("redes tag:metodo"), ["201901131249", "201902010900"])
+        self.assertEqual(self.run_query("mercados tag:metodo"), [])
+
+    def test_phrase(self):
+        self.assertEqual(self.run_query('"efeito causal"'), ["201902010900"])
+
+    def test_negation_and_or(self):
+        self.assertEqual(self.run_query("redes -tag:rascunho"), ["201901131249"])
+        self.assertEqual(self.run_query("mercados OR efeito"), ["201902010900", "202003050800"])
+
+    def test_links_title_and_date(self):
+        self.assertEqual(self.run_query("link:201901131249"), ["202003050800"])
+        self.assertEqual(self.run_query("cites:@silva2019"), ["201902010900"])
+        self.assertEqual(self.run_query("title:efeito"), ["201902010900"])
+        self.assertEqual(self.run_query("date:2020.."), ["202003050800"])
+
+    def test_bare_tag_is_not_a_word_prefix(self):
+        # "redes" aparece no texto de 201902010900, mas só 201901131249 tem #redes
+        self.assertEqual(self.run_query("#redes"), ["201901131249"])
+        self.assertEqual(self.run_query("@silva2019"), ["201902010900"])
+
+    def test_rank_tag_boost_matches_tag_start(self):
+        index = wmZk_index.NoteIndex()
+        # mais recente: ganharia o desempate se #midia contasse para "ia"
+        index.upsert("201901010000", "Um", "#midia", 2.0)
+        index.upsert("201901020000", "Dois", "#ia_generativa", 1.0)
+        search = wmZk_index.SearchIndex()
+        for id in index.records:
+            search.set_note(id, {"texto": [0]})
+        self.assertEqual(search.rank(list(index.records), ["ia"], index), ["201901020000", "201901010000"])
+        self.assertEqual(search.rank(list(index.records), ["midia"], index), ["201901010000", "201901020000"])
+
+    def test_regex_checks_remaining_files(self):
+        self.assertEqual(self.run_query("redes caus.l+idade"), ["201901131249"])
+        self.assertEqual(self.run_query("redes -caus.l+idade"), ["201902010900"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,287 @@
+'''
+Testes da atualização dos índices (update_all e update_note) numa pasta
+de notas temporária.
+
+    python -m unittest discover tests
+'''
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wmZk_index
+
+
+def note_text(id, title, body="", tags=""):
+    return "---\nid: %s\ntitle: %s\ntags: %s\n---\n%s\n" % (id, title, tags, body)
+
+
+class VaultTest(unittest.TestCase):
+    '''
+    Pasta de notas temporária (o índice fica na mesma pasta, como no plugin)
+    '''
+    storage = "csv"
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.write("201901131249 redes.md", note_text("201901131249", "Redes", "ver [[201902010900]]", "#metodo"))
+        self.write("201902010900 causal.md", note_text("201902010900", "Efeito causal", "texto sobre causalidade"))
+        self.write("201903050800 outra.md", note_text("201903050800", "Outra", "cita [[201901131249]] @silva2019"))
+
+    def write(self, name, text):
+        path = os.path.join(self.folder, name)
+        with open(path, "w", encoding="utf8") as file:
+            file.write(text)
+        # mtime diferente do anterior, mesmo em sistemas de arquivos com
+        # resolução de segundos
+        status = os.stat(path)
+        stamp = getattr(self, "stamp", status.st_mtime) + 10
+        self.stamp = stamp
+        os.utime(path, (stamp, stamp))
+        return path
+
+    def update(self, rebuild=False):
+        with redirect_stdout(StringIO()):
+            wmZk_index.update_all(self.folder, self.folder, rebuild, self.storage, 1)
+
+    def update_note(self, path, *cached):
+        with redirect_stdout(StringIO()):
+            return wmZk_index.update_note(self.folder, self.folder, path, self.storage, *cached)
+
+    def ids(self):
+        return sorted(wmZk_index.read_stored_index(self.folder, self.storage).records)
+
+    def sources(self):
+        return sorted(wmZk_index.read_stored_links(self.folder, self.storage).sources)
+
+    def searched(self, term):
+        return sorted(wmZk_index.read_search_index(self.folder).match_term(term))
+
+    def parsed(self, update):
+        '''
+        Roda `update()` e retorna lista de (arquivo, nota ou None se o
+        conteúdo não mudou) de cada nota lida
+        '''
+        calls = []
+        parse_note = wmZk_index.parse_note
+
+        def recorder(file, *args, **kwargs):
+            note = parse_note(file, *args, **kwargs)
+            calls.append((os.path.basename(file), note))
+            return note
+        with mock.patch.object(wmZk_index, "parse_note", recorder):
+            update()
+        return calls
+
+    def assert_matches_rebuild(self):
+        '''
+        Compara índices atualizados aos índices reconstruídos do zero numa
+        cópia das notas
+        '''
+        copy = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, copy)
+        for name in os.listdir(self.folder):
+            if name.endswith(".md"):
+                shutil.copy2(os.path.join(self.folder, name), copy)
+        with redirect_stdout(StringIO()):
+            wmZk_index.update_all(copy, copy, True, self.storage, 1)
+        for folder in (self.folder, copy):
+            index = wmZk_index.read_stored_index(folder, self.storage)
+            links = wmZk_index.read_stored_links(folder, self.storage)
+            search = wmZk_index.read_search_index(folder)
+            if folder == copy:
+                self.assertEqual(index.rows(), expected[0])
+                self.assertEqual(sorted(links.rows()), expected[1])
+                self.assertEqual(search.notes, expected[2])
+            expected = index.rows(), sorted(links.rows()), search.notes
+
+
+class UpdateAllTest(VaultTest):
+    def test_id_change_removes_old_id(self):
+        self.update(True)
+        self.write("201901131249 redes.md", note_text("201901131250", "Redes", "ver [[201902010900]]"))
+        self.update()
+        self.assertEqual(self.ids(), ["201901131250", "201902010900", "201903050800"])
+        self.assertEqual(self.sources(), ["201901131250", "201903050800"])
+        self.assertEqual(self.searched("redes"), ["201901131250"])
+        self.assert_matches_rebuild()
+
+    def test_id_change_in_separate_updates(self):
+        self.update(True)
+        self.write("201901131249 redes.md", note_text("201901131250", "Redes", "ver [[201902010900]]"))
+        with redirect_stdout(StringIO()):
+            wmZk_index.update_index(self.folder, self.folder, storage=self.storage, workers=1)
+            wmZk_index.update_links(self.folder, self.folder, storage=self.storage, workers=1)
+        self.assertEqual(self.ids(), ["201901131250", "201902010900", "201903050800"])
+        self.assertEqual(self.sources(), ["201901131250", "201903050800"])
+
+    def test_delete(self):
+        self.update(True)
+        os.remove(os.path.join(self.folder, "201903050800 outra.md"))
+        self.update()
+        self.assertEqual(self.ids(), ["201901131249", "201902010900"])
+        self.assertEqual(self.sources(), ["201901131249"])
+        self.assertEqual(self.searched("cita"), [])
+        self.assert_matches_rebuild()
+
+    def test_rename_keeps_id_without_reading(self):
+        self.update(True)
+        os.rename(os.path.join(self.folder, "201902010900 causal.md"),
+                  os.path.join(self.folder, "201902010900 efeito causal.md"))
+        self.assertEqual(self.parsed(self.update), [])
+        self.assertEqual(self.ids(), ["201901131249", "201902010900", "201903050800"])
+        manifest = wmZk_index.read_manifest(self.folder, "index")
+        self.assertEqual(manifest["201902010900 efeito causal.md"][3], "201902010900")
+        self.assertNotIn("201902010900 causal.md", manifest)
+
+    def test_new_note_and_edit(self):
+        self.update(True)
+        self.write("201904010800 nova.md", note_text("201904010800", "Nova", "ver [[201902010900]]", "#metodo"))
+        self.write("201902010900 causal.md", note_text("201902010900", "Efeito causal", "agora sobre redes"))
+        self.update()
+        self.assertEqual(self.searched("redes"), ["201901131249", "201902010900"])
+        index = wmZk_index.read_stored_index(self.folder, self.storage)
+        self.assertEqual(sorted(index.tags["#metodo"]), ["201901131249", "201904010800"])
+        self.assert_matches_rebuild()
+
+    def test_touch_skips_unchanged_content(self):
+        self.update(True)
+        path = os.path.join(self.folder, "201901131249 redes.md")
+        rows = wmZk_index.read_stored_index(self.folder, self.storage).rows()
+        os.utime(path, (self.stamp + 100, self.stamp + 100))
+        self.assertEqual(self.parsed(self.update), [("201901131249 redes.md", None)])
+        self.assertEqual(wmZk_index.read_stored_index(self.folder, self.storage).rows(), rows)
+        # manifesto atualizado: a nota não é lida de novo
+        self.assertEqual(self.parsed(self.update), [])
+
+    def test_nothing_changed(self):
+        self.update(True)
+        self.assertEqual(self.parsed(self.update), [])
+
+
+class UpdateNoteTest(VaultTest):
+    def setUp(self):
+        VaultTest.setUp(self)
+        self.update(True)
+
+    def test_save(self):
+        path = self.write("201902010900 causal.md", note_text("201902010900", "Efeito causal", "sobre redes [[201903050800]]"))
+        index, links, search = self.update_note(path)
+        self.assertEqual(index.get("201902010900").title, "Efeito causal")
+        self.assertEqual(links.sources["201902010900"][1], ["201903050800"])
+        # sem índice de busca em cache, só o shard da nota é lido
+        self.assertEqual(sorted(search.notes), ["201902010900"])
+        self.assertEqual(self.searched("redes"), ["201901131249", "201902010900"])
+        # a atualização completa seguinte não relê a nota
+        self.assertEqual(self.parsed(self.update), [])
+        self.assert_matches_rebuild()
+
+    def test_cached_indexes_not_changed(self):
+        # índices em cache no plugin são lidos por outras threads durante
+        # a atualização: update_note altera cópias
+        index = wmZk_index.read_stored_index(self.folder, self.storage)
+        links = wmZk_index.read_stored_links(self.folder, self.storage)
+        search = wmZk_index.read_search_index(self.folder)
+        rows, link_rows, notes = index.rows(), sorted(links.rows()), dict(search.notes)
+        tags = dict((tag, set(ids)) for tag, ids in index.tags.items())
+        postings = dict((term, dict(ids)) for term, ids in search.postings.items())
+        path = self.write("201901131249 redes.md", note_text("201901131249", "Redes novas", "sobre efeito", "#outra"))
+        result = self.update_note(path, index, links, search)
+        self.assertEqual((index.rows(), sorted(links.rows()), search.notes), (rows, link_rows, notes))
+        self.assertEqual((index.tags, search.postings), (tags, postings))
+        self.assertEqual(result[0].get("201901131249").title, "Redes novas")
+        self.assertEqual(sorted(result[2].match_term("efeito")), ["201901131249", "201902010900"])
+        self.assertEqual(sorted(result[2].match_term("ver")), [])
+        self.assert_matches_rebuild()
+
+    def test_new_note(self):
+        path = self.write("201904010800 nova.md", note_text("201904010800", "Nova", "texto"))
+        self.update_note(path)
+        self.assertEqual(self.ids(), ["201901131249", "201902010900", "201903050800", "201904010800"])
+        self.assert_matches_rebuild()
+
+    def test_unchanged_content(self):
+        path = os.path.join(self.folder, "201901131249 redes.md")
+        os.utime(path, (self.stamp + 100, self.stamp + 100))
+        self.assertIsNone(self.update_note(path))
+        self.assertEqual(self.parsed(self.update), [])
+
+    def test_id_change(self):
+        path = self.write("201901131249 redes.md", note_text("201901131250", "Redes", "ver [[201902010900]]"))
+        self.update_note(path)
+        self.assertEqual(self.ids(), ["201901131250", "201902010900", "201903050800"])
+        self.assertEqual(self.sources(), ["201901131250", "201903050800"])
+        self.assert_matches_rebuild()
+
+    def test_outside_notes_folder(self):
+        self.assertIsNone(self.update_note(os.path.join(tempfile.gettempdir(), "x.md")))
+
+
+class IndexLockTest(VaultTest):
+    def test_waits_for_other_holder(self):
+        acquired = threading.Event()
+
+        def other():
+            with wmZk_index.index_lock(self.folder):
+                acquired.set()
+        with wmZk_index.index_lock(self.folder):
+            thread = threading.Thread(target=other)
+            thread.start()
+            self.assertFalse(acquired.wait(0.2))
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+    def test_update_note_without_manifests_runs_update_all(self):
+        # update_note (com a trava) chama update_all, que não trava de novo
+        path = os.path.join(self.folder, "201901131249 redes.md")
+        self.assertIsNone(self.update_note(path))
+        self.assertEqual(self.ids(), ["201901131249", "201902010900", "201903050800"])
+
+
+class BinaryIndexTest(VaultTest):
+    def test_matches_csv_index(self):
+        self.update(True)
+        index = wmZk_index.read_index(self.folder)
+        self.assertEqual(wmZk_index.binary_note_title(self.folder, "201902010900"), "Efeito causal")
+        self.assertIsNone(wmZk_index.binary_note_title(self.folder, "209901010000"))
+        self.assertEqual(wmZk_index.binary_note_list(self.folder),
+                         [row[0] + " " + row[1] for row in index.rows()[1:]])
+
+
+class ShardsUpdateAllTest(UpdateAllTest):
+    storage = "shards"
+
+    def test_export_flat_matches_shards(self):
+        self.update(True)
+        self.write("201904010800 nova.md", note_text("201904010800", "Nova", "ver [[201902010900]]"))
+        self.update()
+        wmZk_index.export_flat(self.folder)
+        self.assertEqual(wmZk_index.read_index(self.folder).rows(),
+                         wmZk_index.read_index_shards(self.folder).rows())
+        self.assertEqual(sorted(wmZk_index.read_links(self.folder).rows()),
+                         sorted(wmZk_index.read_link_shards(self.folder).rows()))
+
+
+class ShardsUpdateNoteTest(UpdateNoteTest):
+    storage = "shards"
+
+
+@unittest.skipIf(wmZk_index.sqlite3 is None, "sqlite3 indisponível")
+class SqliteUpdateAllTest(UpdateAllTest):
+    storage = "sqlite"
+
+
+@unittest.skipIf(wmZk_index.sqlite3 is None, "sqlite3 indisponível")
+class SqliteUpdateNoteTest(UpdateNoteTest):
+    storage = "sqlite"
+
+
+if __name__ == "__main__":
+    unittest.main()
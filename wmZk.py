@@ -5,7 +5,8 @@ import csv
 import time
 import sys
 import subprocess
-import shlex
+import threading
+from itertools import islice
 
 if os.path.dirname(__file__) not in sys.path:
     sys.path.append(os.path.dirname(__file__))
@@ -28,6 +29,12 @@ def plugin_loaded():
     global R_PATH
     global PYTHON_PATH
     global RIPGREP_PATH
+    global STORAGE
+    global INDEX_WORKERS
+    global SEARCH_BACKEND
+    global COMPLETIONS
+    global SEARCH_RESULTS
+    global ASYNC_SEARCH
 
     settings = sublime.load_settings("wmZk.sublime-settings")
     NOTES_FOLDER = settings.get("notes_folder")
@@ -39,14 +46,21 @@ def plugin_loaded():
     R_PATH = settings.get("r_path")
     PYTHON_PATH = settings.get("python_path")
     RIPGREP_PATH = settings.get("ripgrep_path")
+    STORAGE = settings.get("storage", "csv")
+    INDEX_WORKERS = settings.get("index_workers", 1) or None
+    SEARCH_BACKEND = settings.get("search_backend", "index")
+    COMPLETIONS = settings.get("completions", True)
+    SEARCH_RESULTS = settings.get("search_results", 200) or None
+    ASYNC_SEARCH = settings.get("async_search", True)
+    if settings.get("metrics", False):
+        wmZk_index.enable_metrics(INDEX_FOLDER)
 
     if BIB_FILE:
-       update_biblio_list()
+       BIBLIO_TASK.start()
        
     if not os.path.exists(INDEX_FOLDER):
         os.mkdir(INDEX_FOLDER)
-        wmZk_index.update_index(NOTES_FOLDER, INDEX_FOLDER, True, True)
-        wmZk_index.update_links(NOTES_FOLDER, INDEX_FOLDER, True)
+        INDEX_TASK.start(True)
 
 
 
@@ -56,75 +70,311 @@ RESULT_VIEW = None
 #### Basic functions
 ###
 
-def get_note_list(folder):
+# Cache dos índices lidos do disco: (pasta, arquivo, loader) -> (chave de
+# validade, dados). Os dados são descartados quando wmZk_index grava algum
+# índice neste processo (GENERATION) ou quando o arquivo muda em disco
+# (ex.: atualizado pelo wmZk_index rodando em outro processo).
+INDEX_CACHE = {}
+
+
+def cache_key(folder, filename):
+    try:
+        status = os.stat(os.path.join(folder, filename))
+        return (wmZk_index.GENERATION, status.st_mtime, status.st_size)
+    except OSError:
+        return (wmZk_index.GENERATION, None, None)
+
+
+def peek(folder, filename, loader):
+    '''
+    Retorna dados em cache de `loader` se ainda válidos (se não, None)
+    '''
+    entry = INDEX_CACHE.get((folder, filename, loader))
+    if entry is not None and entry[0] == cache_key(folder, filename):
+        return entry[1]
+    return None
+
+
+def remember(folder, filename, loader, data, key=None):
+    '''
+    Registra `data` como resultado atual de `loader` (ex.: índice já
+    atualizado em memória, sem precisar ler de novo o arquivo gravado).
+    `key` é a chave de validade tomada antes de `data` ser montado; se o
+    arquivo mudar depois disso, o cache é descartado na próxima consulta.
+    '''
+    if key is None:
+        key = cache_key(folder, filename)
+    INDEX_CACHE[(folder, filename, loader)] = (key, data)
+
+
+def cached(folder, filename, loader):
+    '''
+    Retorna `loader(folder)`, reaproveitando o resultado anterior enquanto
+    `filename` em `folder` não mudar
+    '''
+    key = cache_key(folder, filename)
+    entry = INDEX_CACHE.get((folder, filename, loader))
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    try:
+        data = loader(folder)
+    except (OSError, ValueError, IndexError, csv.Error) as error:
+        # Arquivo trocado ou apagado durante a leitura (ex.: por outro
+        # processo): segue com a última versão lida, e tenta de novo na
+        # próxima consulta
+        if entry is None:
+            raise
+        print("wmZk: mantendo %s anterior (%s)" % (filename, error))
+        return entry[1]
+    remember(folder, filename, loader, data, key)
+    return data
+
+
+def load_note_list(folder):
     with open(os.path.join(folder, ".index.zkdata"),
               encoding="utf8") as csvfile:
         reader = csv.DictReader(csvfile)
-        index = list(reader)
-    note_list = []
-    for row in index:
-        note_list.append(row["id"] + " " + row["title"])
-    return note_list
+        return [row["id"] + " " + row["title"] for row in reader]
+
+
+def load_shard_note_list(folder):
+    return [row[0] + " " + row[1] for row in islice(load_index(folder).rows(), 1, None)]
+
+
+def has_binary_index(folder):
+    return os.path.exists(os.path.join(folder, wmZk_index.BINARY_FILE))
+
+
+def index_source():
+    '''
+    Arquivo e função de leitura do índice de notas no armazenamento configurado
+    '''
+    if STORAGE == "shards":
+        return wmZk_index.SHARDS_STAMP, wmZk_index.read_index_shards
+    return ".index.zkdata", wmZk_index.read_index
+
+
+def links_source():
+    '''
+    Arquivo e função de leitura da tabela de links no armazenamento configurado
+    '''
+    if STORAGE == "shards":
+        return wmZk_index.SHARDS_STAMP, wmZk_index.read_link_shards
+    return ".links.zkdata", wmZk_index.read_links
+
+
+def load_index(folder):
+    filename, loader = index_source()
+    return cached(folder, filename, loader)
+
+
+def load_tags(folder):
+    if STORAGE == "shards":
+        return cached(folder, wmZk_index.SHARDS_STAMP, wmZk_index.read_shard_tags)
+    return cached(folder, ".tags.zkdata", wmZk_index.read_tags)
+
+
+def load_backlinks(folder):
+    return cached(folder, ".backlinks.zkdata", wmZk_index.read_backlinks)
+
+
+# Trava do índice de trigramas dos títulos: atualizado em segundo plano
+# (TITLE_TASK), consultado ao completar links
+TITLE_LOCK = threading.Lock()
+
+
+def load_title_index(folder):
+    '''
+    Índice de trigramas com "id título" de cada nota, para completar links.
+    Quando o índice de notas muda, o índice de trigramas anterior é
+    atualizado no lugar (só as notas novas ou alteradas são reindexadas).
+    '''
+    filename, loader = index_source()
+    with TITLE_LOCK:
+        key = cache_key(folder, filename)
+        entry = INDEX_CACHE.get((folder, filename, load_title_index))
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        titles = wmZk_index.TrigramIndex() if entry is None else entry[1]
+        titles.sync((record.id, record.id + " " + record.title)
+                    for record in load_index(folder).records.values())
+        remember(folder, filename, load_title_index, titles, key)
+        return titles
+
+
+def load_search_index(folder):
+    return cached(folder, wmZk_index.SEARCH_STAMP, wmZk_index.read_search_index)
+
+
+@wmZk_index.measured("get_note_list")
+def get_note_list(folder):
+    if STORAGE == "sqlite":
+        return wmZk_index.db_note_list(folder)
+    # cópia, já que comandos acrescentam itens à lista
+    if STORAGE == "shards":
+        return list(cached(folder, wmZk_index.SHARDS_STAMP, load_shard_note_list))
+    if has_binary_index(folder):
+        return list(cached(folder, wmZk_index.BINARY_FILE, wmZk_index.binary_note_list))
+    return list(cached(folder, ".index.zkdata", load_note_list))
 
 
+@wmZk_index.measured("get_tag_list")
 def get_tag_list(folder):
-    with open(
-            os.path.join(folder, ".index.zkdata"), encoding="utf8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        index = list(reader)
-    tag_list = []
-    for row in index:
-        note_tags = row['tags']
-        for tag in note_tags.split(";"):
-            if tag not in tag_list and tag != "":
-                tag_list.append(tag)
-    tag_list.sort()
-    return tag_list
+    if STORAGE == "sqlite":
+        return wmZk_index.db_tag_list(folder)
+    return list(load_tags(folder))
+
+
+@wmZk_index.measured("get_tag_counts")
+def get_tag_counts(folder):
+    '''
+    Retorna lista de pares (tag, número de notas com a tag)
+    '''
+    if STORAGE == "sqlite":
+        return wmZk_index.db_tag_counts(folder)
+    return [(tag, len(ids)) for tag, ids in load_tags(folder).items()]
 
 
+def get_tag_items(folder):
+    '''
+    Retorna lista de tags e itens para o quick panel (tag e número de notas)
+    '''
+    counts = get_tag_counts(folder)
+    tags = [tag for tag, count in counts]
+    items = [[tag, "%d notas" % count] for tag, count in counts]
+    return tags, items
+
+
+@wmZk_index.measured("get_notes_by_tag")
 def get_notes_by_tag(folder, tag):
     '''
     Retorna lista de notas que contém a tag fornecida
     '''
-    with open(
-            os.path.join(folder, ".index.zkdata"), encoding="utf8") as csvfile:
-        reader = csv.reader(csvfile)
-        index = list(reader)
-    filtered = list(filter(lambda row: tag in row[2], index))
-    note_list = []
-    for row in filtered:
-        note_list.append(row[0] + " " + row[1])
-    return note_list
+    if STORAGE == "sqlite":
+        return wmZk_index.db_notes_by_tag(folder, tag)
+    index = load_index(folder)
+    return [id + " " + index.get(id).title for id in load_tags(folder).get(tag, []) if id in index]
 
 
+@wmZk_index.measured("get_notes_by_link")
 def get_notes_by_link(folder, id):
     '''
     Retorna lista de notas que linkam para o id fornecido
     '''
-    with open(
-            os.path.join(folder, ".links.zkdata"), encoding="utf8") as csvfile:
-        reader = csv.reader(csvfile)
-        index = list(reader)
-    filtered = list(filter(lambda row: id in row[1], index))
-    note_list = []
-    for row in filtered:
-        note_list.append(row[0] + " " + row[2])
-    return note_list
+    if STORAGE == "sqlite":
+        return wmZk_index.db_notes_by_link(folder, id)
+    if STORAGE == "shards":
+        return wmZk_index.shard_notes_by_link(folder, id)
+    return [source + " " + fromtitle for source, fromtitle in load_backlinks(folder).get(id, [])]
 
 
+@wmZk_index.measured("get_note_title_by_id")
 def get_note_title_by_id(folder, id):
     '''
     Retorna titulo de nota com o id fornecido
     '''
-    with open(
-            os.path.join(folder, ".index.zkdata"), encoding="utf8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        index = list(reader)
-    note_title = None
-    for row in index:
-        if row["id"] == id:
-            note_title = row["title"]
-    return note_title
+    if STORAGE == "sqlite":
+        return wmZk_index.db_note_title(folder, id)
+    if STORAGE == "shards" and peek(folder, *index_source()) is None:
+        # sem índice completo em cache: lê só o shard da nota
+        return wmZk_index.shard_note_title(folder, id)
+    if STORAGE == "csv" and peek(folder, *index_source()) is None and has_binary_index(folder):
+        # sem índice completo em cache: busca binária em `.index.zkbin`
+        return wmZk_index.binary_note_title(folder, id)
+    record = load_index(folder).get(id)
+    if record is None:
+        return None
+    return record.title
+
+
+def stream_query(folder, groups):
+    '''
+    Gera ids das notas que satisfazem a consulta `groups` (ver
+    wmZk_index.parse_query), respondida com os índices em cache, à medida
+    que são encontradas
+    '''
+    paths = None
+    if any(predicate.field == "regex" for group in groups for predicate in group):
+        paths = wmZk_index.note_paths(NOTES_FOLDER, folder)
+    plan = wmZk_index.QueryPlan(load_index(folder), load_search_index(folder),
+                                lambda id: [item.split(" ", 1)[0] for item in get_notes_by_link(folder, id)],
+                                paths)
+    return plan.stream(groups)
+
+
+@wmZk_index.measured("query_notes")
+def query_notes(folder, groups):
+    return set(stream_query(folder, groups))
+
+
+def highlight_regex(groups):
+    '''
+    Regex para destacar, nas notas encontradas, os termos buscados
+    '''
+    parts = []
+    for group in groups:
+        for predicate in group:
+            if predicate.negated or predicate.field in ("title", "date"):
+                continue
+            if predicate.field in ("text", "regex"):
+                parts.append(predicate.value)
+            elif predicate.field == "tag":
+                parts.append(re.escape(predicate.value))
+            else:
+                parts.append(r"\[\[\s*%s\s*\]\]|@%s" % (re.escape(predicate.value), re.escape(predicate.value)))
+    # sem termos para destacar: início da nota
+    return "|".join(parts) or r"\A"
+
+
+@wmZk_index.measured("rank_notes")
+def rank_notes(folder, ids, terms, limit=None):
+    '''
+    Retorna lista "id título" das notas `ids` (ex.: resultado de uma
+    busca), das mais relevantes para `terms` às menos relevantes (BM25,
+    com peso extra para título e tags), com no máximo `limit` notas
+    '''
+    index = load_index(folder)
+    ids = load_search_index(folder).rank([id for id in ids if id in index], terms, index, limit)
+    return [id + " " + index.get(id).title for id in ids]
+
+
+def title_matches(folder, query, limit=20):
+    '''
+    Retorna lista de pares (id, "id título") das notas com título mais
+    parecido com `query` (sem `query`, as notas mais recentes), ou None se
+    o índice de trigramas ainda está sendo atualizado (em segundo plano)
+    '''
+    if not query.strip():
+        return [(item.split(" ", 1)[0], item) for item in get_note_list(folder)[:limit]]
+    filename, loader = index_source()
+    if not TITLE_LOCK.acquire(blocking=False):
+        return None
+    try:
+        titles = peek(folder, filename, load_title_index)
+        if titles is not None:
+            return titles.search(query, limit)
+    finally:
+        TITLE_LOCK.release()
+    TITLE_TASK.start()
+    return None
+
+
+def citekey_matches(folder, query, limit=20):
+    '''
+    Retorna lista de pares (citekey, texto) das referências do arquivo .bib
+    mais parecidas com `query` (sem arquivo .bib, das notas de fichamento),
+    ou None se ainda não foram carregadas
+    '''
+    if BIB_FILE:
+        if "CITEKEY_INDEX" not in globals():
+            return None
+        return CITEKEY_INDEX.search(query, limit)
+    matches = title_matches(folder, query, limit * 10)
+    if matches is None:
+        return None
+    return [(id, text) for id, text in matches
+            if wmZk_index.note_shard(id) == wmZk_index.BIBLIO_SHARD][:limit]
+
 
 def get_citation(ref):
     '''
@@ -172,39 +422,187 @@ def get_citation(ref):
     reference = biblib.algo.tex_to_unicode(reference)
     return reference
 
-def update_data(links=False, get_body_tags=False):
+class BackgroundTask(object):
+    '''
+    Executa `function(rebuild)` numa thread separada, para não travar o
+    editor, com progresso na barra de status. Só uma execução por vez:
+    pedidos feitos durante uma execução são juntados numa única execução
+    seguinte (com rebuild = True se algum dos pedidos foi de rebuild).
+    '''
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.running = False
+        # None = nenhum pedido pendente
+        self.pending = None
+
+    def start(self, rebuild=False):
+        if self.acquire(rebuild):
+            self.spawn(rebuild)
+
+    def ensure_started(self):
+        '''
+        Inicia execução se a tarefa está parada. Se já está em execução, não
+        registra novo pedido (ex.: quem só precisa esperar a execução em
+        andamento terminar)
+        '''
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        self.spawn(False)
+
+    def acquire(self, rebuild=False):
+        '''
+        Marca a tarefa como em execução. Se já está, registra o pedido
+        e retorna False
+        '''
+        with self.lock:
+            if self.running:
+                self.pending = bool(self.pending) or rebuild
+                return False
+            self.running = True
+            return True
+
+    def finish(self):
+        '''
+        Encerra execução feita fora da thread (após `acquire`), iniciando
+        a execução pendente, se houver
+        '''
+        rebuild = self.release()
+        if rebuild is not None:
+            self.spawn(rebuild)
+
+    def release(self):
+        '''
+        Retorna pedido pendente; se não há, a tarefa deixa de estar em execução
+        '''
+        with self.lock:
+            rebuild = self.pending
+            self.pending = None
+            if rebuild is None:
+                self.running = False
+                self.idle.notify_all()
+            return rebuild
+
+    def spawn(self, rebuild):
+        threading.Thread(target=self.worker, args=(rebuild,), daemon=True).start()
+        sublime.set_timeout(self.show_progress, 0)
+
+    def worker(self, rebuild):
+        while rebuild is not None:
+            try:
+                self.function(rebuild)
+            except Exception as error:
+                print("wmZk: erro %s: %s" % (self.name, error))
+            rebuild = self.release()
+
+    def wait(self):
+        '''
+        Espera até que não haja execução em andamento
+        '''
+        with self.lock:
+            while self.running:
+                self.idle.wait()
+
+    def show_progress(self, step=0):
+        if not self.running:
+            sublime.status_message("wmZk: %s... ok" % self.name)
+            return
+        bar = [" "] * 6
+        bar[step % 6] = "="
+        sublime.status_message("wmZk: %s [%s]" % (self.name, "".join(bar)))
+        sublime.set_timeout(lambda: self.show_progress(step + 1), 200)
+
+
+def update_data(links=False, search=False):
     '''
     Checa se indíce (ou lista de links) foi atualizado nos últimos 5 minutos.
-    Se não, atualiza. 
-    links = True atualiza lista de links em vez de notas.
+    Se não, atualiza em segundo plano (INDEX_TASK), e o comando segue com
+    os índices atuais; só espera a atualização se ainda não há índice.
+    links = True checa lista de links em vez de notas.
+    search = True checa índice de busca.
+    Notas salvas no Sublime já são indexadas ao salvar (ReindexOnSave);
+    esta checagem pega as alterações feitas fora do editor.
     '''
-    if links:
+    if not wmZk_index.index_exists(INDEX_FOLDER, STORAGE):
+        # update_all já reconstrói tudo quando não há índice
+        INDEX_TASK.ensure_started()
+        INDEX_TASK.wait()
+        return
+    if search:
+        timestamp_file = ".search.zktimestamp"
+    elif links:
         timestamp_file = ".links.zktimestamp"
     else:
         timestamp_file = ".index.zktimestamp"
     # Última atualização
-    timestamp = open(os.path.join(INDEX_FOLDER, timestamp_file), "r").read()
-    timestamp = float(timestamp)
+    if os.path.exists(os.path.join(INDEX_FOLDER, timestamp_file)):
+        timestamp = open(os.path.join(INDEX_FOLDER, timestamp_file), "r").read()
+        timestamp = float(timestamp)
+    else:
+        timestamp = 0
     # É antes de 5 minutos atrás?
     if timestamp < (time.time() - 300):
-        if links:
-            wmZk_index.update_links(NOTES_FOLDER, INDEX_FOLDER, False)
-        else:
-            wmZk_index.update_index(NOTES_FOLDER, INDEX_FOLDER, False, get_body_tags)
+        INDEX_TASK.start()
+
+
+def update_note(file):
+    '''
+    Atualiza índices só com a nota `file` (ex.: logo depois de salva),
+    reaproveitando os índices em cache. Se uma atualização completa está
+    em andamento, a nota fica para a próxima (que a encontra pelo manifesto).
+    '''
+    if not INDEX_TASK.acquire():
+        return
+    filename, loader = index_source()
+    links_filename, links_loader = links_source()
+    try:
+        search = peek(INDEX_FOLDER, wmZk_index.SEARCH_STAMP, wmZk_index.read_search_index)
+        result = wmZk_index.update_note(
+            NOTES_FOLDER, INDEX_FOLDER, file, STORAGE,
+            peek(INDEX_FOLDER, filename, loader),
+            peek(INDEX_FOLDER, links_filename, links_loader),
+            search)
+        if result is not None:
+            # update_note altera cópias dos índices em cache (lidos por outras
+            # threads ao mesmo tempo), que os substituem no cache; índice e
+            # links (lidos por inteiro) ficam em cache para o próximo salvamento
+            remember(INDEX_FOLDER, filename, loader, result[0])
+            remember(INDEX_FOLDER, links_filename, links_loader, result[1])
+            # sem índice de busca em cache, update_note lê só os shards da nota
+            if search is not None:
+                remember(INDEX_FOLDER, wmZk_index.SEARCH_STAMP, wmZk_index.read_search_index, result[2])
+    finally:
+        INDEX_TASK.finish()
+
 
 def update_biblio_list():
+    '''
+    Carrega lista de referências do arquivo .bib. Se a lista já foi
+    carregada e o arquivo mudou, recarrega em segundo plano (BIBLIO_TASK)
+    e segue com a lista atual.
+    '''
+    if "BIB_FILE_MODIFIED_TIME" not in globals():
+        BIBLIO_TASK.ensure_started()
+        BIBLIO_TASK.wait()
+    elif BIB_FILE_MODIFIED_TIME != os.path.getmtime(BIB_FILE):
+        BIBLIO_TASK.start()
+
+
+@wmZk_index.measured("load_biblio_list")
+def load_biblio_list(rebuild=False):
     global REFERENCES_LIST
+    global CITEKEY_INDEX
     global LIBRARY
     global BIB_FILE_MODIFIED_TIME
 
-    if "BIB_FILE_MODIFIED_TIME" in globals():
-        if BIB_FILE_MODIFIED_TIME  == os.path.getmtime(BIB_FILE):
-            return
-
-    LIBRARY = citer.load_bibfile(BIB_FILE)
-    BIB_FILE_MODIFIED_TIME = os.path.getmtime(BIB_FILE)
-    REFERENCES_LIST = []
-    for record in LIBRARY:
+    modified_time = os.path.getmtime(BIB_FILE)
+    library = citer.load_bibfile(BIB_FILE)
+    references = []
+    for record in library:
         if "author" in record:
             author = biblib.algo.tex_to_unicode(record["author"])
             n_authors = len(author.split("and"))
@@ -219,8 +617,30 @@ def update_biblio_list():
         title = re.sub(r'{\\textless}/*i{\\textgreater}|{\\text.*?}', '', record["title"])
         title = biblib.algo.tex_to_unicode(title)
         row = "%s - %s (%s) %s" % (record["id"], author, year, title)
-        REFERENCES_LIST.append(row)
-        REFERENCES_LIST.sort()
+        references.append(row)
+    references.sort()
+    citekeys = wmZk_index.TrigramIndex()
+    citekeys.sync((row.split(" ", 1)[0], row) for row in references)
+    # Troca a lista toda de uma vez, para que comandos nunca vejam lista incompleta
+    LIBRARY = library
+    REFERENCES_LIST = references
+    CITEKEY_INDEX = citekeys
+    BIB_FILE_MODIFIED_TIME = modified_time
+
+
+def refresh_index(rebuild=False):
+    if not wmZk_index.index_exists(INDEX_FOLDER, STORAGE):
+        rebuild = True
+    wmZk_index.update_all(NOTES_FOLDER, INDEX_FOLDER, rebuild, STORAGE, INDEX_WORKERS)
+
+
+def refresh_title_index(rebuild=False):
+    load_title_index(INDEX_FOLDER)
+
+
+INDEX_TASK = BackgroundTask("atualizando índice", refresh_index)
+TITLE_TASK = BackgroundTask("indexando títulos", refresh_title_index)
+BIBLIO_TASK = BackgroundTask("carregando referências", load_biblio_list)
 
 
 ###
@@ -280,8 +700,8 @@ class WmzkInsertLinkCommand(sublime_plugin.TextCommand):
 class WmzkInsertTagCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         global tag_list
-        tag_list = get_tag_list(INDEX_FOLDER)
-        self.view.window().show_quick_panel(tag_list, self.on_done)
+        tag_list, tag_items = get_tag_items(INDEX_FOLDER)
+        self.view.window().show_quick_panel(tag_items, self.on_done)
 
     def on_done(self, selection):
         if selection == -1:
@@ -328,21 +748,22 @@ class WmzkInsertImageClipboardCommand(sublime_plugin.TextCommand):
         else:
             pythonexe = "python"
         command = pythonexe + ' "' + helper_path + '" "' + img_path + '" '
-        subprocess.check_output(command, shell=True)
+        with wmZk_index.measure("img_clipboard"):
+            subprocess.check_output(command, shell=True)
         link = "![](" + ATTACHMENTS + img_name + ")"
         self.view.run_command("insert", {"characters": link})
 
 
 class WmzkNotesFromTag(sublime_plugin.TextCommand):
     def run(self, edit, selected_tag=None):
-        update_data(links=False, get_body_tags=True)
+        update_data(links=False)
         global tag_list
-        tag_list = get_tag_list(INDEX_FOLDER)
-        if selected_tag is None:
+        tag_list, tag_items = get_tag_items(INDEX_FOLDER)
+        if selected_tag is None or selected_tag not in tag_list:
             selected_index = 0
         else:
             selected_index = tag_list.index(selected_tag)
-        self.view.window().show_quick_panel(tag_list, self.on_done_tag, selected_index=selected_index)
+        self.view.window().show_quick_panel(tag_items, self.on_done_tag, selected_index=selected_index)
 
     def on_done_tag(self, selection):
         global note_list
@@ -375,6 +796,98 @@ class ResultView(sublime_plugin.EventListener):
             RESULT_VIEW = None
 
 
+class ReindexOnSave(sublime_plugin.EventListener):
+    '''
+    Atualiza índices com a nota salva (sem percorrer a pasta de notas),
+    para que ela apareça logo nas listas de notas, tags e links
+    '''
+    def on_post_save_async(self, view):
+        file = view.file_name()
+        if file is None or not file.endswith(".md"):
+            return
+        if not os.path.abspath(file).startswith(os.path.join(os.path.abspath(NOTES_FOLDER), "")):
+            return
+        update_note(file)
+
+
+# Texto digitado depois de [[ ou de @ até o cursor
+LINK_QUERY = re.compile(r"\[\[([^\[\]]*)$")
+CITEKEY_QUERY = re.compile(r"(?:^|[\s\[;(])@([^\s@\[\];,]*)$")
+
+
+def completion_query(view, point):
+    '''
+    Retorna ("link", texto) se o cursor está num link ainda aberto,
+    ("citekey", texto) se está numa citekey, ou (None, None)
+    '''
+    line = view.substr(sublime.Region(view.line(point).begin(), point))
+    match = LINK_QUERY.search(line)
+    if match:
+        return "link", match.group(1)
+    match = CITEKEY_QUERY.search(line)
+    if match:
+        return "citekey", match.group(1)
+    return None, None
+
+
+class ReferenceCompletions(sublime_plugin.EventListener):
+    '''
+    Completa links ([[) com as notas de título mais parecido com o texto
+    digitado, e citekeys (@) com as referências mais parecidas
+    (busca aproximada em índices de trigramas)
+    '''
+    def on_query_completions(self, view, prefix, locations):
+        if not COMPLETIONS or len(locations) != 1:
+            return None
+        if not view.match_selector(locations[0], "text.html.markdown"):
+            return None
+        kind, query = completion_query(view, locations[0])
+        if kind == "link":
+            matches = title_matches(INDEX_FOLDER, query)
+        elif kind == "citekey":
+            matches = citekey_matches(INDEX_FOLDER, query)
+        else:
+            return None
+        if not matches:
+            return None
+        items = [sublime.CompletionItem.command_completion(
+                     text, "wmzk_complete_reference", {"kind": kind, "key": key},
+                     annotation="nota" if kind == "link" else "referência")
+                 for key, text in matches]
+        return sublime.CompletionList(items, sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_REORDER |
+                                      sublime.DYNAMIC_COMPLETIONS)
+
+    def on_modified_async(self, view):
+        '''
+        Abre completions ao digitar num link ou citekey (ex.: depois de
+        espaço, que fecha a lista)
+        '''
+        if not COMPLETIONS or len(view.sel()) != 1 or not view.sel()[0].empty():
+            return
+        point = view.sel()[0].b
+        if view.is_auto_complete_visible() or not view.match_selector(point, "text.html.markdown"):
+            return
+        if completion_query(view, point)[0] is not None:
+            view.run_command("auto_complete", {"disable_auto_insert": True})
+
+
+class WmzkCompleteReferenceCommand(sublime_plugin.TextCommand):
+    '''
+    Substitui o texto digitado depois de [[ (ou @) pelo link (ou citekey)
+    escolhido na lista de completions
+    '''
+    def run(self, edit, kind, key):
+        point = self.view.sel()[0].b
+        query = completion_query(self.view, point)[1]
+        if query is None:
+            return
+        text = key + "]]" if kind == "link" else key
+        region = sublime.Region(point - len(query), point)
+        self.view.replace(edit, region, text)
+        self.view.sel().clear()
+        self.view.sel().add(sublime.Region(region.begin() + len(text)))
+
+
 class QuickPanelFocus(sublime_plugin.EventListener):
     '''
     Helper para BrowseResults.
@@ -447,6 +960,9 @@ class HoverLink(sublime_plugin.EventListener):
                     content = """
                              <a href="%s">%s</a><br><a href="%s">%s</a>
                               """ % (note_id, note_title, "copy", "📋")
+                n_backlinks = len(get_notes_by_link(INDEX_FOLDER, note_id))
+                if n_backlinks > 0:
+                    content += "<br>%d linking notes" % n_backlinks
                 html = """
                             <body>
                                 <style>
@@ -528,43 +1044,272 @@ class HoverLink(sublime_plugin.EventListener):
             my_view.window().open_file(filename)
 
 
+def ripgrep_terms(groups):
+    '''
+    Termos para buscar com ripgrep (lista), se a consulta só tem termos de
+    texto (sem campos, exclusões ou OR) e a busca é sempre com ripgrep, ou
+    se só tem regex; se não, None (busca nos índices: as notas dos termos
+    de texto são cruzadas primeiro, e as regex só são checadas nos arquivos
+    das notas que restam)
+    '''
+    predicates = [predicate for group in groups for predicate in group]
+    plain = len(groups) == 1 and all(predicate.field in ("text", "regex") and not predicate.negated
+                                     for predicate in predicates)
+    if plain and (SEARCH_BACKEND == "ripgrep" or all(predicate.field == "regex" for predicate in predicates)):
+        return [predicate.value for predicate in predicates]
+    return None
+
+
+def ripgrep_command(terms_list):
+    '''
+    Argumentos para o ripgrep listar as notas com todos os termos
+    '''
+    search_string = "(?s)^" + "".join("(?=.*?" + t + ")" for t in terms_list)
+    return [RIPGREP_PATH or "rg", "-l", "-S", "--pcre2", "--type", "md", search_string, NOTES_FOLDER]
+
+
+def note_id_from_file(file):
+    return os.path.basename(file.rstrip("\r\n")).replace(".md", "")
+
+
+# Intervalo entre lotes de resultados entregues pela busca em segundo
+# plano (s) e espera depois da última tecla antes de buscar (ms)
+SEARCH_BATCH_SECONDS = 0.1
+SEARCH_DELAY = 300
+
+
+class SearchJob(object):
+    '''
+    Busca numa thread separada, sem travar o editor. As notas encontradas
+    (pelo ripgrep, à medida que ele as lista, ou pelos índices) são
+    entregues em lotes à thread principal (`on_batch(job, lista "id título")`);
+    ao terminar, `on_finish(job, ids, notas ordenadas por relevância)`, ou
+    `on_error(job, mensagem)` se a busca falhou.
+    `cancel` interrompe a busca (e o ripgrep); depois disso nenhum lote é entregue.
+    '''
+    def __init__(self, query, groups, on_batch, on_finish, on_error):
+        self.query = query
+        self.groups = groups
+        self.on_batch = on_batch
+        self.on_finish = on_finish
+        self.on_error = on_error
+        self.cancelled = threading.Event()
+        self.process = None
+        # notas entregues até agora ("id título") e resultado final
+        self.lines = []
+        self.result = None
+        # abrir lista de resultados ao terminar (Enter no painel de busca)
+        self.open_results = False
+
+    def start(self):
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    def cancel(self):
+        self.cancelled.set()
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.kill()
+
+    def deliver(self, function, *args):
+        sublime.set_timeout(lambda: self.cancelled.is_set() or function(self, *args), 0)
+
+    def worker(self):
+        terms = ripgrep_terms(self.groups)
+        try:
+            if terms is not None:
+                update_data(links=False)
+                found = self.stream_ripgrep(terms)
+            else:
+                update_data(search=True)
+                found = stream_query(INDEX_FOLDER, self.groups)
+            ids = []
+            batch = []
+            last = time.time()
+            for id in found:
+                if self.cancelled.is_set():
+                    return
+                title = get_note_title_by_id(INDEX_FOLDER, id)
+                if title is None:
+                    continue
+                ids.append(id)
+                batch.append(id + " " + title)
+                if time.time() - last >= SEARCH_BATCH_SECONDS:
+                    self.deliver(self.on_batch, batch)
+                    batch = []
+                    last = time.time()
+            if batch:
+                self.deliver(self.on_batch, batch)
+            if self.cancelled.is_set():
+                return
+            note_list = rank_notes(INDEX_FOLDER, ids, wmZk_index.query_terms(self.groups), SEARCH_RESULTS)
+            self.deliver(self.on_finish, ids, note_list)
+        except re.error as error:
+            self.deliver(self.on_error, "invalid regex (%s)" % error)
+        except OSError as error:
+            self.deliver(self.on_error, "could not run ripgrep (%s)" % error)
+        except Exception as error:
+            # sem isso a thread termina em silêncio e o painel de busca
+            # fica aberto
+            print("wmZk: erro na busca %s: %s" % (self.query, error))
+            self.deliver(self.on_error, "search failed (%s)" % error)
+
+    def stream_ripgrep(self, terms_list):
+        '''
+        Gera ids das notas à medida que o ripgrep as lista
+        '''
+        with wmZk_index.measure("ripgrep"):
+            self.process = subprocess.Popen(ripgrep_command(terms_list), stdout=subprocess.PIPE,
+                                            stderr=subprocess.DEVNULL,
+                                            creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+            if self.cancelled.is_set():
+                self.process.kill()
+            try:
+                for line in self.process.stdout:
+                    yield note_id_from_file(line.decode("UTF-8"))
+            finally:
+                self.process.stdout.close()
+                self.process.wait()
+
+
 class WmzkCustomSearchCommand(sublime_plugin.TextCommand):
+    '''
+    Pesquisa de notas. Com "async_search", a busca é feita em segundo plano
+    enquanto se digita (cada tecla cancela a busca anterior), com o número
+    de notas encontradas na barra de status; com Enter, a lista de
+    resultados abre assim que a busca termina, e as notas já encontradas
+    aparecem antes num painel.
+    '''
     def run(self, edit):
-        self.view.window().show_input_panel("Search", "", self.find, None, None)
+        self.job = None
+        self.typed = None
+        on_change = self.on_change if ASYNC_SEARCH else None
+        self.view.window().show_input_panel("Search", "", self.find, on_change, self.on_cancel)
+
+    def parse(self, string, show_errors=True):
+        try:
+            groups = wmZk_index.parse_query(string)
+        except ValueError as error:
+            # enquanto se digita, aspas ainda abertas são normais
+            if show_errors:
+                sublime.error_message("wmZk: invalid query (%s)" % error)
+            return None
+        return groups or None
+
+    def on_change(self, string):
+        self.typed = string
+        if self.job is not None and self.job.query != string:
+            self.job.cancel()
+        sublime.set_timeout(lambda: self.search_typed(string), SEARCH_DELAY)
+
+    def search_typed(self, string):
+        job = self.job
+        if string != self.typed or (job is not None and job.query == string and not job.cancelled.is_set()):
+            return
+        groups = self.parse(string, show_errors=False)
+        if groups is not None:
+            self.start_search(string, groups)
+
+    def on_cancel(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.job = None
 
     def find(self, string):
-        update_data(links=False, get_body_tags=True)
-        terms_list = shlex.split(string)
-        regex = "|".join(terms_list)
-        terms = []
-        for t in terms_list:
-            terms.append("(?=.*?" + t + ")")
-        terms = "".join(terms)
-        search_string = '"(?s)^' + terms + '"'
-        if RIPGREP_PATH:
-            ripgrepexe = '"' + RIPGREP_PATH + '"'
+        self.typed = string
+        if not ASYNC_SEARCH:
+            self.find_blocking(string)
+            return
+        job = self.job
+        if job is None or job.query != string or job.cancelled.is_set():
+            groups = self.parse(string)
+            if groups is None:
+                return
+            job = self.start_search(string, groups)
+        if job.result is not None:
+            self.show_results(job)
+            return
+        job.open_results = True
+        panel = self.view.window().create_output_panel("wmzk_search")
+        panel.run_command("append", {"characters": "Searching: %s\n" % string})
+        panel.run_command("append", {"characters": "".join(line + "\n" for line in job.lines)})
+        self.view.window().run_command("show_panel", {"panel": "output.wmzk_search"})
+
+    def start_search(self, string, groups):
+        if self.job is not None:
+            self.job.cancel()
+        self.job = SearchJob(string, groups, self.on_batch, self.on_finish, self.on_error)
+        self.job.start()
+        return self.job
+
+    def on_batch(self, job, lines):
+        if job is not self.job:
+            return
+        job.lines.extend(lines)
+        sublime.status_message("wmZk: searching %s... %d notes" % (job.query, len(job.lines)))
+        if job.open_results:
+            panel = self.view.window().find_output_panel("wmzk_search")
+            if panel is not None:
+                panel.run_command("append", {"characters": "".join(line + "\n" for line in lines)})
+
+    def on_finish(self, job, ids, note_list):
+        if job is not self.job:
+            return
+        job.result = (ids, note_list)
+        sublime.status_message("wmZk: %s: %d notes found" % (job.query, len(ids)))
+        if job.open_results:
+            self.view.window().destroy_output_panel("wmzk_search")
+            self.show_results(job)
+
+    def on_error(self, job, message):
+        if job is not self.job:
+            return
+        self.job = None
+        if job.open_results:
+            self.view.window().destroy_output_panel("wmzk_search")
+        sublime.error_message("wmZk: " + message)
+
+    def show_results(self, job):
+        ids, note_list = job.result
+        self.job = None
+        header = str(len(ids)) + " notes found"
+        if len(note_list) < len(ids):
+            header += " (%d most relevant)" % len(note_list)
+        self.view.run_command(
+            'wmzk_browse_results', {'results': note_list, 'header': header, 'regex': highlight_regex(job.groups)})
+
+    def find_blocking(self, string):
+        groups = self.parse(string)
+        if groups is None:
+            return
+        terms = ripgrep_terms(groups)
+        if terms is not None:
+            update_data(links=False)
+            ids = self.find_ripgrep(terms)
         else:
-            ripgrepexe = "rg"
-        command = ripgrepexe + r' -l -S --pcre2 --type md ' + search_string + r' ' + NOTES_FOLDER
-        output = subprocess.check_output(command, shell=True)
-        file_list = output.decode("UTF-8").split("\n")
-        note_list = []
-        for file in file_list:
-            note_id = os.path.basename(file)
-            note_id = note_id.replace(".md", "")
-            # Abaixo a função get_note_title_by_id() copiada
-            # já que chamá-la diretamente não funcionou
-            with open(
-                    os.path.join(INDEX_FOLDER, ".index.zkdata"), encoding="utf8") as csvfile:
-                reader = csv.DictReader(csvfile)
-                index = list(reader)
-            for row in index:
-                if row["id"] == note_id:
-                    note_title = row["title"]
-                    note_list.append(note_id + " " + note_title)
-        header = str(len(note_list)) + " notes found"
+            update_data(search=True)
+            try:
+                ids = query_notes(INDEX_FOLDER, groups)
+            except re.error as error:
+                sublime.error_message("wmZk: invalid regex (%s)" % error)
+                return
+        note_list = rank_notes(INDEX_FOLDER, ids, wmZk_index.query_terms(groups), SEARCH_RESULTS)
+        header = str(len(ids)) + " notes found"
+        if len(note_list) < len(ids):
+            header += " (%d most relevant)" % len(note_list)
         self.view.run_command(
-            'wmzk_browse_results', {'results': note_list, 'header': header, 'regex': regex })
+            'wmzk_browse_results', {'results': note_list, 'header': header, 'regex': highlight_regex(groups)})
+
+    def find_ripgrep(self, terms_list):
+        try:
+            with wmZk_index.measure("ripgrep"):
+                output = subprocess.check_output(ripgrep_command(terms_list),
+                                                 creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+        except subprocess.CalledProcessError:
+            # ripgrep retorna 1 quando não há resultados
+            return []
+        file_list = output.decode("UTF-8").split("\n")
+        # ids das notas encontradas (ordenadas depois por relevância)
+        return [note_id_from_file(file) for file in file_list if file.strip()]
 
 
 class WmzkBrowseResultsCommand(sublime_plugin.TextCommand):
@@ -707,7 +1452,8 @@ class WmzkNewBiblioNote(sublime_plugin.TextCommand):
             if CSL:
                 arg_csl = "--csl=" + CSL
                 args.append(arg_csl)  
-            complete = pypandoc.convert_text(text, 'plain', format='markdown+yaml_metadata_block', extra_args=args)
+            with wmZk_index.measure("pandoc"):
+                complete = pypandoc.convert_text(text, 'plain', format='markdown+yaml_metadata_block', extra_args=args)
         contents = ('---\nid: %s\ntitle: "%s"\ntags: #fichamentos\n---\n\n%s$1\n\n'
                     "Resumo:\n>\n\n# Comentários gerais\n\n$2\n\n# Objetivos e questões de pesquisa\n\n\n"
                     "# Metodologia\n\n\n# Principais resultados e contribuições\n\n\n"
@@ -757,33 +1503,68 @@ class WmzkSidebar(sublime_plugin.TextCommand):
 
 class WmzkNotesNetwork(sublime_plugin.TextCommand):
     def run(self, edit):
-        update_data(links=False, get_body_tags=True)
-        update_data(links=True)
-        global NETWORK_PROCESS
-        pkg_path = sublime.packages_path()
-        vis_path = os.path.join(pkg_path, "wmZk/visualiza_notas_shinyApp.R")
-        if R_PATH:
-            rscriptexe = '"' + R_PATH + '"'
-        else:
-            rscriptexe = "Rscript.exe"
-        command = rscriptexe + ' "' + vis_path + '" "' + INDEX_FOLDER + '" "' + NOTES_FOLDER + '"'
+        NETWORK_TASK.start()
+
+
+def prepare_network(rebuild=False):
+    '''
+    Atualiza os índices (esperando a atualização terminar, já que o app em
+    R lê os arquivos uma só vez) e, ao terminar, inicia o app na thread
+    principal
+    '''
+    update_data(links=True)
+    INDEX_TASK.wait()
+    if STORAGE == "shards":
+        # o app em R lê os CSVs únicos
+        wmZk_index.export_flat(INDEX_FOLDER)
+    sublime.set_timeout(start_network, 0)
+
+
+def start_network():
+    global NETWORK_PROCESS
+    pkg_path = sublime.packages_path()
+    vis_path = os.path.join(pkg_path, "wmZk/visualiza_notas_shinyApp.R")
+    if R_PATH:
+        rscriptexe = '"' + R_PATH + '"'
+    else:
+        rscriptexe = "Rscript.exe"
+    command = rscriptexe + ' "' + vis_path + '" "' + INDEX_FOLDER + '" "' + NOTES_FOLDER + '"'
+    with wmZk_index.measure("rscript_start"):
         NETWORK_PROCESS = subprocess.Popen(command, shell=False)
-        NETWORK_PROCESS
+
+
+NETWORK_TASK = BackgroundTask("preparando rede de notas", prepare_network)
 
 
 # Funções de atualização para menu
+# (índice e links são atualizados juntos, numa única passada pelas notas,
+# em segundo plano)
 class WmzkMenuUpdateIndex(sublime_plugin.TextCommand):
     def run(self, edit):
-        wmZk_index.update_index(NOTES_FOLDER, INDEX_FOLDER, False, True)
+        INDEX_TASK.start()
 
 class WmzkMenuRecreateIndex(sublime_plugin.TextCommand):
     def run(self, edit):
-        wmZk_index.update_index(NOTES_FOLDER, INDEX_FOLDER, True, True)
+        INDEX_TASK.start(True)
 
 class WmzkMenuUpdateLinks(sublime_plugin.TextCommand):
     def run(self, edit):
-        wmZk_index.update_links(NOTES_FOLDER, INDEX_FOLDER, False)
+        INDEX_TASK.start()
 
 class WmzkMenuRecreateLinks(sublime_plugin.TextCommand):
     def run(self, edit):
-        wmZk_index.update_links(NOTES_FOLDER, INDEX_FOLDER, True)
\ No newline at end of file
+        INDEX_TASK.start(True)
+
+
+class WmzkPerformanceReport(sublime_plugin.TextCommand):
+    '''
+    Resume tempos das operações medidas (setting "metrics": true)
+    '''
+    def run(self, edit):
+        report = wmZk_index.performance_report(INDEX_FOLDER)
+        if not wmZk_index.read_metrics(INDEX_FOLDER):
+            report = 'Nenhuma medição gravada. Ative "metrics": true nas configurações do wmZk.'
+        new_view = self.view.window().new_file()
+        new_view.set_name("wmZk: desempenho")
+        new_view.set_scratch(True)
+        new_view.run_command("append", {"characters": report + "\n"})
@@ -7,138 +7,1206 @@ plugin fo Sublime Text.
 import os
 import re
 import sys
-import markdown
+import io
 import time
 import csv
-from itertools import islice
-from operator import itemgetter
+import zlib
+import math
+import json
+import select
+import shlex
+import mmap
+import struct
+import unicodedata
+import functools
+import contextlib
+import threading
+from itertools import islice, repeat
+from collections import namedtuple, OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from operator import attrgetter
+from bisect import bisect_left
+from urllib.request import pathname2url
+from heapq import nlargest, nsmallest
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+# ----------------------------------------------------------
+# Medição de desempenho
+# ----------------------------------------------------------
+
+# Pasta em que as medições são gravadas (None = medição desligada; as
+# funções medidas só checam esta variável)
+METRICS_FOLDER = None
+METRICS_FILE = ".zkmetrics.txt"
+
+
+def enable_metrics(folder):
+    '''
+    Liga medição de tempo das funções marcadas com `measured`, gravando
+    em `.zkmetrics.txt` em `folder` (None desliga)
+    '''
+    global METRICS_FOLDER
+    METRICS_FOLDER = folder
+
+
+def record_metric(name, seconds, items=None):
+    '''
+    Acrescenta uma medição (uma linha JSON) ao arquivo de medições
+    '''
+    if METRICS_FOLDER is None:
+        return
+    entry = {"time": round(time.time(), 3), "op": name, "seconds": round(seconds, 6)}
+    if items is not None:
+        entry["items"] = items
+    with open(os.path.join(METRICS_FOLDER, METRICS_FILE), "a", encoding="utf8") as file:
+        file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+@contextlib.contextmanager
+def measure(name, items=None):
+    '''
+    Mede o tempo de um bloco `with` (ex.: chamada de programa externo)
+    '''
+    if METRICS_FOLDER is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_metric(name, time.perf_counter() - start, items)
+
+
+def measured(name, items=None):
+    '''
+    Decorador que mede o tempo de cada chamada da função quando a medição
+    está ligada. `items` (opcional) recebe os mesmos argumentos da função
+    e retorna o número de itens processados (ex.: notas lidas).
+    '''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if METRICS_FOLDER is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_metric(name, time.perf_counter() - start,
+                              None if items is None else items(*args, **kwargs))
+        return wrapper
+    return decorate
+
+
+def count_files(files, *args, **kwargs):
+    return len(files)
+
+
+def read_metrics(folder):
+    '''
+    Lê medições gravadas em `folder` e retorna dict operação -> lista de
+    (segundos, itens)
+    '''
+    metrics = OrderedDict()
+    filename = os.path.join(folder, METRICS_FILE)
+    if not os.path.exists(filename):
+        return metrics
+    with open(filename, encoding="utf8") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # linha incompleta (ex.: gravação interrompida)
+                continue
+            metrics.setdefault(entry["op"], []).append((entry["seconds"], entry.get("items")))
+    return metrics
+
+
+def percentile(values, share):
+    '''
+    Percentil `share` (0 a 1) de `values` já ordenados (vizinho mais próximo)
+    '''
+    return values[max(0, int(math.ceil(share * len(values))) - 1)]
+
+
+def performance_report(folder):
+    '''
+    Resume medições gravadas em `folder`: para cada operação, número de
+    chamadas, p50, p95, máximo e total (em ms) e média de itens por chamada.
+    Retorna texto da tabela (operações mais demoradas no total primeiro).
+    '''
+    rows = []
+    for name, entries in read_metrics(folder).items():
+        times = sorted(seconds * 1000 for seconds, items in entries)
+        items = [items for seconds, items in entries if items is not None]
+        rows.append([name, len(times), percentile(times, 0.5), percentile(times, 0.95), times[-1], sum(times),
+                     "%.0f" % (float(sum(items)) / len(items)) if items else ""])
+    rows.sort(key=lambda row: row[5], reverse=True)
+    lines = ["%-24s %7s %10s %10s %10s %11s %8s" % ("operação", "n", "p50 ms", "p95 ms", "máx ms", "total ms", "itens")]
+    for row in rows:
+        lines.append(("%-24s %7d %10.2f %10.2f %10.2f %11.1f %8s" % tuple(row)).rstrip())
+    return "\n".join(lines)
 
 
 # ----------------------------------------------------------
 # Funções básicas
 # ----------------------------------------------------------
 
+NOTE_EXTENSION = ".md"
+# Contador incrementado a cada gravação de índice neste processo,
+# para que o plugin saiba quando descartar dados em cache
+GENERATION = 0
+MANIFEST_HEADER = ["path", "mtime", "size", "inode", "id", "hash"]
+# Tentativas de substituir um arquivo de índice (no Windows a troca falha
+# enquanto outro processo está com o arquivo aberto para leitura)
+REPLACE_ATTEMPTS = 20
+REPLACE_DELAY = 0.05
+
+
+@contextlib.contextmanager
+def replacing(filename, mode="w", **kwargs):
+    '''
+    Abre arquivo temporário para gravar no lugar de `filename`. Ao fim do
+    bloco `with` (sem erro), o temporário substitui `filename` com
+    `os.replace`: leitores (o plugin, em outra thread, ou outro processo)
+    veem sempre a versão anterior completa ou a nova, nunca um arquivo
+    pela metade.
+    '''
+    temporary = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        with open(temporary, mode, **kwargs) as file:
+            yield file
+        for attempt in range(REPLACE_ATTEMPTS):
+            try:
+                os.replace(temporary, filename)
+                break
+            except PermissionError:
+                if attempt == REPLACE_ATTEMPTS - 1:
+                    raise
+                time.sleep(REPLACE_DELAY)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+# Arquivo travado (na pasta do índice) durante cada atualização, para que
+# o plugin e o observador (`watch`, em outro processo) não gravem índices
+# montados a partir de manifestos que o outro já substituiu
+LOCK_FILE = ".zklock"
+# Pastas cuja trava já é mantida pela thread atual (ex.: update_note que
+# chama update_all)
+HELD_LOCKS = threading.local()
+
+
+def lock_file(file):
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+    elif msvcrt is not None:
+        file.seek(0)
+        while True:
+            try:
+                # LK_LOCK desiste depois de 10 tentativas (10 s)
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue
+
+
+def unlock_file(file):
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    elif msvcrt is not None:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextlib.contextmanager
+def index_lock(folder):
+    '''
+    Trava `.zklock` em `folder` durante o bloco `with`, esperando se outro
+    processo (ou thread) está atualizando os índices. A trava é liberada
+    pelo sistema se o processo termina sem liberá-la.
+    '''
+    held = HELD_LOCKS.__dict__.setdefault("folders", set())
+    key = os.path.abspath(folder)
+    if key in held:
+        yield
+        return
+    with open(os.path.join(folder, LOCK_FILE), "a+b") as file:
+        lock_file(file)
+        held.add(key)
+        try:
+            yield
+        finally:
+            held.discard(key)
+            unlock_file(file)
+
+
+def locked(function):
+    '''
+    Decorador para funções de atualização `function(notes_folder,
+    index_folder, ...)`: executa com `index_lock(index_folder)`
+    '''
+    @functools.wraps(function)
+    def wrapper(notes_folder, index_folder, *args, **kwargs):
+        with index_lock(index_folder):
+            return function(notes_folder, index_folder, *args, **kwargs)
+    return wrapper
+
+
+@measured("scan_notes")
+def scan_notes(folder):
+    '''
+    Percorre `folder` (e subpastas, exceto as ocultas) com `os.scandir` e
+    retorna dict com caminho relativo de cada arquivo .md ->
+    (mtime, size, inode).
+    A extensão é filtrada antes de consultar o status do arquivo, e o status
+    vem do próprio DirEntry (sem `os.stat` adicional no Windows).
+    '''
+    scan = {}
+    pending = [""]
+    while pending:
+        relative = pending.pop()
+        with os.scandir(os.path.join(folder, relative)) as entries:
+            for entry in entries:
+                name = entry.name
+                if entry.is_dir():
+                    if not name.startswith("."):
+                        pending.append(os.path.join(relative, name))
+                elif name.endswith(NOTE_EXTENSION):
+                    scan[os.path.join(relative, name)] = entry_status(entry)
+    return scan
+
+
+def stat_status(status):
+    '''
+    (mtime, size, inode) de um `os.stat_result`. No Windows o inode é
+    gravado como 0: o de `DirEntry.stat()` é sempre 0 e o de `os.stat`,
+    não, e a nota pareceria modificada se os dois fossem comparados.
+    '''
+    return (status.st_mtime, status.st_size, 0 if os.name == "nt" else status.st_ino)
+
+
+def entry_status(entry):
+    return stat_status(entry.stat())
+
+
+def note_status(file):
+    '''
+    Retorna (mtime, size, inode) de um arquivo, como `scan_notes`
+    '''
+    return stat_status(os.stat(file))
+
+
 def get_modified_notes(folder, timestamp=0):
     '''
     Retorna lista de arquivos .md em `folder` modificados desde `timestamp`
     (default retorna todos os arquivos)
     '''
+    return [os.path.join(folder, path)
+            for path, (mtime, size, inode) in scan_notes(folder).items()
+            if mtime > timestamp]
+
+
+def read_manifest(folder, name):
+    '''
+    Lê manifesto `.<name>.zkmanifest` em `folder`
+    (caminho -> [mtime, size, inode, id, hash do conteúdo]).
+    Retorna None se o manifesto não existe.
+    '''
+    filename = os.path.join(folder, "." + name + ".zkmanifest")
+    if not os.path.exists(filename):
+        return None
+    manifest = {}
+    with open(filename, 'r', encoding='utf-8') as file:
+        for row in islice(csv.reader(file), 1, None):
+            id = row[4] if len(row) > 4 else note_id_from_path(row[0])
+            hash = int(row[5]) if len(row) > 5 and row[5] != "" else None
+            manifest[row[0]] = [float(row[1]), int(row[2]), int(row[3]), id, hash]
+    return manifest
+
+
+def write_manifest(manifest, folder, name):
+    '''
+    Grava manifesto `.<name>.zkmanifest` em `folder`
+    '''
+    with replacing(os.path.join(folder, "." + name + ".zkmanifest"), newline="", encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(MANIFEST_HEADER)
+        for path, (mtime, size, inode, id, hash) in manifest.items():
+            writer.writerow([path, repr(mtime), size, inode, id, "" if hash is None else hash])
+
+
+def bump_generation():
+    global GENERATION
+    GENERATION += 1
+
+
+def note_id_from_path(path):
+    '''
+    Id de uma nota a partir do nome do arquivo (convenção `<id>.md`)
+    '''
+    return os.path.basename(path)[:-len(NOTE_EXTENSION)]
+
+
+def diff_manifest(old, new):
+    '''
+    Compara manifesto `old` com `new` (resultado de `scan_notes`) e retorna
+    listas (caminhos relativos) de arquivos acrescentados, modificados,
+    removidos e renomeados (pares antigo, novo).
+    Um arquivo removido é candidato a renomeado se há um arquivo novo
+    com os mesmos mtime, size e inode (no Windows o inode é sempre 0: os
+    candidatos devem ser confirmados pelo conteúdo, ver `confirm_renames`).
+    '''
+    added = []
     modified = []
-    for root, dirs, files in os.walk(folder):
-        for basename in files:
-            filename = os.path.join(root, basename)
-            status = os.stat(filename)
-            if basename.endswith(".md") and (status.st_mtime > timestamp):
-                modified.append(filename)
-    return modified
-
-
-def get_notes_metadata(filelist, index=None, get_body_tags=False):
-    '''
-    Loop por `filelist` e cria uma lista de listas com metadados das notas.
-    Se uma lista de listas `index` é fornecida, registros são acrescentados ou 
-    atualizados.
-    Retorna o a lista de listas, número de notas criadas e número de notas atualizadas.
-    Layout da lista de listas (variáveis): 
+    for path, status in new.items():
+        previous = old.get(path)
+        if previous is None:
+            added.append(path)
+        elif tuple(previous[:3]) != status:
+            modified.append(path)
+    deleted = [path for path in old if path not in new]
+    renamed = []
+    if added and deleted:
+        by_status = {}
+        for path in deleted:
+            by_status[tuple(old[path][:3])] = path
+        for path in added:
+            source = by_status.pop(new[path], None)
+            if source is not None:
+                renamed.append((source, path))
+        if renamed:
+            moved = set()
+            for source, path in renamed:
+                moved.add(source)
+                moved.add(path)
+            added = [path for path in added if path not in moved]
+            deleted = [path for path in deleted if path not in moved]
+    return added, modified, deleted, renamed
+
+
+def file_hash(file):
+    with open(file, "rb") as myfile:
+        return content_hash(myfile.read())
+
+
+def confirm_renames(notes_folder, old, renamed):
+    '''
+    Dentre os pares (antigo, novo) de `diff_manifest`, retorna os
+    confirmados (conteúdo do arquivo novo com o mesmo hash registrado no
+    manifesto `old` para o antigo) e os caminhos dos demais, que voltam a
+    ser tratados como acrescentados e removidos
+    '''
+    confirmed = []
+    added = []
+    deleted = []
+    for source, path in renamed:
+        hash = old[source][4]
+        try:
+            same = hash is not None and file_hash(os.path.join(notes_folder, path)) == hash
+        except OSError:
+            same = False
+        if same:
+            confirmed.append((source, path))
+        else:
+            added.append(path)
+            deleted.append(source)
+    return confirmed, added, deleted
+
+
+def get_changed_notes(notes_folder, index_folder, name, rebuild=False, scan=None):
+    '''
+    Compara estado atual de `notes_folder` com o manifesto `name` salvo em
+    `index_folder`. Retorna o novo manifesto, listas de caminhos relativos
+    de notas acrescentadas e modificadas, e lista de ids das notas removidas.
+    No novo manifesto, notas modificadas mantêm id e hash anteriores até que
+    sejam lidas (o hash permite ignorar notas cujo mtime mudou mas o
+    conteúdo não); o id de notas acrescentadas fica vazio. Notas renomeadas
+    mantêm o id anterior e não precisam ser lidas de novo (só o hash do
+    conteúdo é conferido).
+    Se `rebuild` = True, todas as notas são tratadas como novas. Se ainda
+    não houver manifesto, usa o timestamp da última atualização (e não
+    detecta notas removidas).
+    Um `scan` já feito (resultado de `scan_notes`) pode ser reaproveitado.
+    '''
+    if scan is None:
+        scan = scan_notes(notes_folder)
+    manifest = dict((path, [mtime, size, inode, "", None]) for path, (mtime, size, inode) in scan.items())
+    if rebuild:
+        return manifest, list(scan), [], []
+    old = read_manifest(index_folder, name)
+    if old is None and not os.path.exists(os.path.join(index_folder, "." + name + ".zktimestamp")):
+        # Primeira atualização deste índice
+        return manifest, list(scan), [], []
+    if old is None:
+        timestamp = open(os.path.join(index_folder, "." + name + ".zktimestamp"), "r").read()
+        timestamp = float(timestamp)
+        modified = []
+        for path, entry in manifest.items():
+            if entry[0] > timestamp:
+                modified.append(path)
+            else:
+                entry[3] = note_id_from_path(path)
+        return manifest, [], modified, []
+    added, modified, deleted, renamed = diff_manifest(old, scan)
+    renamed, unconfirmed_added, unconfirmed_deleted = confirm_renames(notes_folder, old, renamed)
+    added += unconfirmed_added
+    deleted += unconfirmed_deleted
+    for path, entry in manifest.items():
+        previous = old.get(path)
+        if previous is not None:
+            entry[3] = previous[3]
+            entry[4] = previous[4]
+    for source, path in renamed:
+        manifest[path][3] = old[source][3]
+        manifest[path][4] = old[source][4]
+    deleted = [old[path][3] or note_id_from_path(path) for path in deleted]
+    return manifest, added, modified, deleted
+
+
+def get_removed_ids(manifest, deleted):
+    '''
+    Dentre os ids de notas removidas (`deleted`), retorna os que não
+    pertencem a nenhuma nota do manifesto atualizado (ex.: nota movida
+    para outro arquivo com conteúdo alterado)
+    '''
+    if not deleted:
+        return []
+    live = set(entry[3] for entry in manifest.values())
+    return [id for id in set(deleted) if id not in live]
+
+
+def read_changed_notes(notes_folder, manifest, paths, reader, *args, **kwargs):
+    '''
+    Chama `reader` (get_notes_metadata ou get_links) para as notas
+    em `paths` (caminhos relativos) e registra no manifesto o id e o hash
+    de cada uma. Notas com hash igual ao do manifesto são ignoradas.
+    Retorna o resultado de `reader`, a lista de ids das notas lidas e a
+    lista de ids anteriores das notas cujo id mudou (ex.: alterado no front
+    matter), a serem removidos.
+    '''
+    paths = sorted(paths)
+    files = dict((os.path.join(notes_folder, path), path) for path in paths)
+    hashes = [manifest[path][4] for path in paths]
+    notes = {}
+    result = reader(list(files), *args, notes=notes, hashes=hashes, **kwargs)
+    replaced = []
+    for file, note in notes.items():
+        entry = manifest[files[file]]
+        if entry[3] not in ("", note.id):
+            replaced.append(entry[3])
+        entry[3] = note.id
+        entry[4] = note.hash
+    return result, [note.id for note in notes.values()], replaced
+
+
+INDEX_HEADER = ["id", "title", "tags", "modified"]
+TAGS_HEADER = ["tag", "count", "ids"]
+
+
+class NoteRecord(object):
+    '''
+    Registro compacto de uma nota no índice (uma linha de `.index.zkdata`)
+    '''
+    __slots__ = ("id", "title", "tags", "modified")
+
+    def __init__(self, id, title, tags, modified):
+        self.id = id
+        self.title = title
+        self.tags = tags
+        self.modified = modified
+
+    def as_row(self):
+        return [self.id, self.title, self.tags, self.modified]
+
+
+def split_tags(tags):
+    return [tag for tag in tags.split(";") if tag != ""]
+
+
+class NoteIndex(object):
+    '''
+    Índice de notas em memória, indexado por id.
+    Acrescentar ou atualizar uma nota (`upsert`) é O(1); a ordenação por
+    data de modificação só é feita ao gerar as linhas para gravação.
+    Mantém também índice invertido de tags (tag -> conjunto de ids),
+    atualizado a cada alteração.
+    '''
+    def __init__(self):
+        self.records = {}
+        self.tags = {}
+        # ids alterados desde a última gravação em shards
+        self.touched = set()
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''
+        Cria índice a partir de lista de listas (com header), como lida
+        de `.index.zkdata`
+        '''
+        index = cls()
+        for row in islice(rows, 1, None):
+            index.upsert(row[0], row[1], row[2], float(row[3]))
+        index.touched.clear()
+        return index
+
+    def __len__(self):
+        return len(self.records)
+
+    def copy(self):
+        '''
+        Retorna cópia que pode ser alterada sem afetar este índice (ex.: em
+        cache no plugin e lido por outras threads)
+        '''
+        index = NoteIndex()
+        index.records = dict(self.records)
+        index.tags = dict((tag, set(ids)) for tag, ids in self.tags.items())
+        index.touched = set(self.touched)
+        return index
+
+    def __contains__(self, id):
+        return id in self.records
+
+    def get(self, id):
+        return self.records.get(id)
+
+    def upsert(self, id, title, tags, modified):
+        '''
+        Acrescenta ou atualiza nota. Retorna True se a nota é nova.
+        '''
+        self.touched.add(id)
+        record = self.records.get(id)
+        if record is None:
+            self.records[id] = NoteRecord(id, title, tags, modified)
+            self.add_tags(id, tags)
+            return True
+        if record.tags != tags:
+            self.remove_tags(id, record.tags)
+            self.add_tags(id, tags)
+        # registro novo, e não alterado no lugar: pode ser compartilhado
+        # com cópias do índice (ver copy)
+        self.records[id] = NoteRecord(id, title, tags, modified)
+        return False
+
+    def remove(self, id):
+        '''
+        Remove nota do índice. Retorna True se a nota existia.
+        '''
+        record = self.records.pop(id, None)
+        if record is None:
+            return False
+        self.touched.add(id)
+        self.remove_tags(id, record.tags)
+        return True
+
+    def add_tags(self, id, tags):
+        for tag in split_tags(tags):
+            self.tags.setdefault(tag, set()).add(id)
+
+    def remove_tags(self, id, tags):
+        for tag in split_tags(tags):
+            ids = self.tags.get(tag)
+            if ids is not None:
+                ids.discard(id)
+                if not ids:
+                    del self.tags[tag]
+
+    def tag_rows(self):
+        '''
+        Retorna lista de listas com header (layout de `.tags.zkdata`): uma
+        linha por tag, em ordem alfabética, com número de notas e ids
+        (separados por espaço, das notas mais recentes para as mais antigas)
+        '''
+        rows = [list(TAGS_HEADER)]
+        for tag in sorted(self.tags):
+            records = sorted((self.records[id] for id in self.tags[tag]),
+                             key=attrgetter("modified", "id"), reverse=True)
+            rows.append([tag, len(records), " ".join(record.id for record in records)])
+        return rows
+
+    def rows(self, ids=None):
+        '''
+        Retorna lista de listas com header, ordenada de forma decrescente
+        com base na coluna modified (layout de `.index.zkdata`).
+        Se `ids` é fornecido, inclui apenas essas notas.
+        '''
+        records = self.records.values()
+        if ids is not None:
+            records = [self.records[id] for id in ids if id in self.records]
+        records = sorted(records, key=attrgetter("modified"), reverse=True)
+        rows = [record.as_row() for record in records]
+        rows.insert(0, list(INDEX_HEADER))
+        return rows
+
+    def recent_rows(self, count):
+        '''
+        Como `rows`, mas só com as `count` notas mais recentes (sem ordenar
+        o índice todo)
+        '''
+        records = nlargest(count, self.records.values(), key=attrgetter("modified"))
+        rows = [record.as_row() for record in records]
+        rows.insert(0, list(INDEX_HEADER))
+        return rows
+
+
+@measured("read_index")
+def read_index(folder):
+    '''
+    Lê `.index.zkdata` em `folder` e retorna NoteIndex
+    '''
+    with open(os.path.join(folder, ".index.zkdata"), 'r', encoding='utf-8') as file:
+        return NoteIndex.from_rows(csv.reader(file))
+
+
+@measured("write_index")
+def write_index(index, folder):
+    '''
+    Grava NoteIndex em `.index.zkdata` (e a cópia binária em `.index.zkbin`)
+    e o índice de tags em `.tags.zkdata`.
+    Retorna as linhas gravadas em `.index.zkdata`.
+    '''
+    bump_generation()
+    rows = index.rows()
+    with replacing(os.path.join(folder, ".index.zkdata"), newline="", encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerows(rows)
+    with replacing(os.path.join(folder, ".tags.zkdata"), newline="", encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerows(index.tag_rows())
+    write_binary_index(index, folder)
+    return rows
+
+
+@measured("read_tags")
+def read_tags(folder):
+    '''
+    Lê `.tags.zkdata` em `folder` e retorna dict tag -> lista de ids
+    (em ordem alfabética de tags). Se o arquivo ainda não existe, usa
+    `.index.zkdata`.
+    '''
+    filename = os.path.join(folder, ".tags.zkdata")
+    if not os.path.exists(filename):
+        rows = read_index(folder).tag_rows()
+    else:
+        with open(filename, 'r', encoding='utf-8') as file:
+            rows = list(csv.reader(file))
+    return tags_from_rows(rows)
+
+
+def tags_from_rows(rows):
+    '''
+    Converte linhas no layout de `.tags.zkdata` em dict tag -> lista de ids
+    '''
+    tags = OrderedDict()
+    for tag, count, ids in islice(rows, 1, None):
+        tags[tag] = ids.split()
+    return tags
+
+
+Note = namedtuple("Note", ["id", "title", "tags", "links", "modified", "hash", "terms"])
+
+
+FRONT_MATTER_KEY = re.compile(r"^([A-Za-z0-9_-]+):\s*(.*?)\s*$")
+
+
+def unquote(value):
+    '''
+    Remove aspas simples ou duplas em volta de `value`
+    '''
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+        return value[1:-1]
+    return value
+
+
+def parse_yaml_value(value):
+    '''
+    Converte valor de um campo do front matter: lista inline (`[a, "b"]`)
+    vira lista; strings entre aspas perdem as aspas
+    '''
+    if value.startswith("[") and value.endswith("]"):
+        return [unquote(item.strip()) for item in value[1:-1].split(",") if item.strip() != ""]
+    return unquote(value)
+
+
+def read_front_matter(lines):
+    '''
+    Lê front matter YAML de `lines` (iterável de linhas, ex.: arquivo aberto),
+    parando no `---` (ou `...`) de fechamento, sem consumir o resto da nota.
+    Aceita strings com aspas, listas inline e listas em várias linhas
+    (`- item`). Como a extensão Meta do python-markdown, também aceita
+    front matter sem `---` de abertura, terminando na primeira linha em branco.
+    Retorna dict com nomes dos campos (em minúsculas) -> valor (str ou lista)
+    '''
+    meta = {}
+    key = None
+    delimited = False
+    for number, line in enumerate(lines):
+        line = line.rstrip("\r\n")
+        if number == 0:
+            line = line.lstrip("\ufeff")
+            if line.strip() == "---":
+                delimited = True
+                continue
+        stripped = line.strip()
+        if stripped in ("---", "...") or (stripped == "" and not delimited):
+            break
+        if stripped == "" or line.startswith("#"):
+            # linha em branco ou comentário
+            continue
+        match = FRONT_MATTER_KEY.match(line)
+        if match and not line[0].isspace():
+            key = match.group(1).lower()
+            meta[key] = parse_yaml_value(match.group(2))
+        elif key is not None and stripped.startswith("- "):
+            # item de lista em várias linhas
+            value = meta[key]
+            if not isinstance(value, list):
+                value = [value] if value != "" else []
+            value.append(unquote(stripped[2:].strip()))
+            meta[key] = value
+        elif key is not None and isinstance(meta[key], str):
+            # continuação de valor em várias linhas
+            meta[key] = (meta[key] + " " + stripped).strip()
+        elif not delimited:
+            break
+    return meta
+
+
+def split_header_tags(tags):
+    '''
+    Converte campo "tags" do front matter em lista de tags. Aceita lista
+    ou string com tags separadas por vírgula e/ou espaço
+    '''
+    if isinstance(tags, list):
+        tags = ",".join(tags)
+    tags = re.sub(r"[\[\]\'\"]", "", tags)
+    return [tag for tag in re.split(r"[,\s]+", tags) if tag != ""]
+
+
+def parse_header(meta, file):
+    '''
+    Extrai id, título e lista de tags do front matter `meta`.
+    Se a nota não tem id, usa o nome do arquivo
+    '''
+    id = meta.get("id")
+    if isinstance(id, list):
+        id = id[0] if id else None
+    if not id:
+        id = note_id_from_path(file)
+    title = meta.get("title", "")
+    if isinstance(title, list):
+        title = ", ".join(title)
+    title = title.strip('"').strip("'")
+    tags = split_header_tags(meta.get("tags", ""))
+    return id, title, tags
+
+
+Token = namedtuple("Token", ["kind", "value", "start", "end"])
+
+# Elementos de uma nota, reconhecidos numa única passada pelo texto.
+# Blocos de código, código inline e URLs são consumidos sem gerar tokens,
+# para que `#` e `@` dentro deles não virem tags ou citações. O lookahead
+# inicial deixa o regex pular rapidamente o texto comum.
+TOKEN = re.compile(r"""
+    (?=[`~ hf!\[@\#])
+    (?:
+        ^[ ]{0,3}(?P<fence>`{3,}|~{3,})[^\n]*\n                      # bloco de código
+            (?:[\s\S]*?^[ ]{0,3}(?P=fence)[^\n]*$|[\s\S]*)
+      | (?P<ticks>`+)[^\n]+?(?P=ticks)                               # código inline
+      | (?:https?|ftp|file)://[^\s<>()\[\]]+                        # URL
+      | !\[[^\]\n]*\]\((?P<image>[^)\s]+)[^)\n]*\)                   # imagem
+      | \[\[\s*(?P<link>\d{12})\s*\]\]                               # link wiki
+      | @(?P<citekey>[^\s\d]+\d{4}\w*)                               # citação
+      | ^\#{1,6}(?=[ \t]+(?P<heading>[^\n]*?)[ \t\#]*$)              # título
+      | (?<![\w&])(?P<tag>\#\w+\.?\w+)                               # tag
+    )
+""", re.MULTILINE | re.VERBOSE)
+TOKEN_KINDS = ("image", "link", "citekey", "heading", "tag")
+
+
+def tokenize(text):
+    '''
+    Percorre `text` uma única vez e gera Token(kind, value, start, end) para
+    cada tag (`#tag`), link wiki (`[[201901131249]]`, value é o id),
+    citação (`@citekey`, value é a citekey), título (`## Título`, value é
+    o texto) e imagem (`![](anexos/img.png)`, value é o caminho), com a
+    posição de value no texto. Ignora o que está em blocos de código,
+    código inline e URLs.
+    '''
+    for match in TOKEN.finditer(text):
+        # último grupo capturado: o do elemento reconhecido (blocos de
+        # código e código inline terminam em "fence" e "ticks"; URLs, em None)
+        kind = match.lastgroup
+        if kind in TOKEN_KINDS:
+            yield Token(kind, match.group(kind), match.start(kind), match.end(kind))
+
+
+def find_tags_and_links(text, id):
+    '''
+    Retorna tags do corpo da nota e links (ids de links wiki e citekeys),
+    sem duplicatas, numa única passada. Ignora referências à própria nota
+    (geralmente em notas bibliográficas). Listas em ordem alfabética, para
+    que os índices gravados não dependam da ordem de iteração de sets
+    (que muda a cada processo).
+    '''
+    tags = set()
+    links = set()
+    for token in tokenize(text):
+        if token.kind == "tag":
+            tags.add(token.value)
+        elif token.kind in ("link", "citekey"):
+            links.add(token.value)
+    links.discard(id)
+    return sorted(tags), sorted(links)
+
+
+def content_hash(data):
+    '''
+    Hash rápido (não criptográfico) do conteúdo de uma nota, em bytes
+    '''
+    return zlib.crc32(data)
+
+
+def parse_note(file, full=True, known_hash=None, terms=False):
+    '''
+    Lê nota `file` uma única vez e extrai, numa só passada, front matter,
+    tags (do campo "tags" e do corpo da nota), links wiki e citekeys.
+    Com `full` = False, extrai apenas o front matter (`links` fica None).
+    Com `terms` = True, também extrai os termos do texto para o índice de
+    busca (se não, `terms` fica None).
+    Se o hash do conteúdo é igual a `known_hash`, a nota não mudou desde a
+    última leitura e retorna None.
+    Retorna Note(id, title, tags, links, modified, hash, terms)
+    '''
+    with open(file, "rb") as myfile:
+        data = myfile.read()
+        modified = os.fstat(myfile.fileno()).st_mtime
+    hash = content_hash(data)
+    if hash == known_hash:
+        return None
+    text = data.decode("utf8")
+    meta = read_front_matter(io.StringIO(text))
+    id, title, tags = parse_header(meta, file)
+    links = None
+    if full:
+        # combina e remove duplicatas
+        body_tags, links = find_tags_and_links(text, id)
+        tags = sorted(set(tags).union(body_tags))
+    return Note(id, title, tags, links, modified, hash, get_terms(text) if terms else None)
+
+
+# Abaixo deste número de notas, a leitura é sempre feita em série
+PARALLEL_MIN_NOTES = 500
+# Número de notas lidas por tarefa do pool de processos
+PARALLEL_CHUNKSIZE = 64
+
+
+def parse_notes_chunk(files, full=True, hashes=None, terms=False):
+    if hashes is None:
+        hashes = repeat(None)
+    return [parse_note(file, full, hash, terms) for file, hash in zip(files, hashes)]
+
+
+@measured("read_notes", count_files)
+def read_notes(files, full=True, workers=1, chunksize=PARALLEL_CHUNKSIZE, hashes=None, terms=False):
+    '''
+    Lê notas em `files` com `parse_note` e retorna lista de Note na mesma
+    ordem de `files`. Se uma lista `hashes` (hash anterior de cada nota, ou
+    None) é fornecida, notas cujo conteúdo não mudou retornam None.
+    `terms` é repassado para `parse_note`.
+    Com `workers` > 1 (ou None, para usar todos os processadores), a lista
+    é dividida em blocos de `chunksize` notas e lida por um pool de
+    processos; os resultados são combinados na ordem original. Vaults
+    pequenos (menos de PARALLEL_MIN_NOTES notas) são lidos em série.
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(files) < PARALLEL_MIN_NOTES:
+        return parse_notes_chunk(files, full, hashes, terms)
+    chunks = [files[i:i + chunksize] for i in range(0, len(files), chunksize)]
+    if hashes is None:
+        hash_chunks = repeat(None, len(chunks))
+    else:
+        hash_chunks = [hashes[i:i + chunksize] for i in range(0, len(hashes), chunksize)]
+    notes = []
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+        for result in pool.map(parse_notes_chunk, chunks, repeat(full, len(chunks)), hash_chunks,
+                               repeat(terms, len(chunks))):
+            notes.extend(result)
+    return notes
+
+
+@measured("get_notes_metadata", count_files)
+def get_notes_metadata(filelist, index=None, get_body_tags=False, notes=None,
+                       workers=1, chunksize=PARALLEL_CHUNKSIZE, hashes=None):
+    '''
+    Loop por `filelist` e cria um NoteIndex com metadados das notas.
+    Se um NoteIndex `index` é fornecido (ou uma lista de listas com header,
+    como lida de `.index.zkdata`), registros são acrescentados ou atualizados.
+    Retorna o índice, número de notas criadas e número de notas atualizadas.
+    Layout de cada registro (variáveis): 
     id, title, tags, modified
 
     Se get_body_tags = True, lê o conteúdo todo da nota e identifica tags tbm no texto
     (não só no campo de "tags")
+
+    Se um dict `notes` é fornecido, registra nele a Note de cada arquivo lido.
+    `workers`, `chunksize` e `hashes` são repassados para `read_notes`
+    (notas com conteúdo inalterado são ignoradas).
     '''
     if index is None:
-        index = []
-    else:
-        #remove header
-        del index[0]
-        # converte modified para numerico
-        for item in index:
-            item[3] = float(item[3])
-    md = markdown.Markdown(extensions = ["markdown.extensions.meta:MetaExtension"])
+        index = NoteIndex()
+    elif not isinstance(index, NoteIndex):
+        index = NoteIndex.from_rows(index)
     count_new = 0
     count_update = 0
-    for file in filelist:
-        # Lê as primeiras 8 linhas
-        with open(file, encoding="utf8") as myfile:
-            header = list(islice(myfile, 8))
-        html = md.convert("".join(header))
-        id = md.Meta['id'][0]
-        title = md.Meta['title'][0].strip('"').strip("'")
-        tags = md.Meta['tags'][0]
-        tags = re.sub(r"[\[\]\s\'\"]", "", tags).split(",")
-        if get_body_tags:
-            # Buscar tags tbm no corpo da nota.
-            # Lê nota inteira e usa regex
-            text = open(file, "r", encoding="utf8").read()
-            body_tags = re.findall(r"(#\w+\.?\w+)", text)
-            # combina e remove duplicatas
-            tags = list(set(tags+body_tags))
-        tags = ";".join(tags)
-        modified_time = os.stat(file).st_mtime
-        # Se id já existe em index, atualiza item;
-        # se não, append item
-        if any(id in sublist for sublist in index):
-            item_updated = [id, title, tags, modified_time]
-            index = [item_updated if item[0]==id else item for item in index]
-            count_update += 1
-        else:
-            index.append([id, title, tags, modified_time])
+    for file, note in zip(filelist, read_notes(filelist, get_body_tags, workers, chunksize, hashes)):
+        if note is None:
+            continue
+        if notes is not None:
+            notes[file] = note
+        # Se id já existe em index, atualiza registro;
+        # se não, acrescenta
+        if index.upsert(note.id, note.title, ";".join(note.tags), note.modified):
             count_new += 1
-    # ordena decrescente com base na coluna modified 
-    index = sorted(index, key=itemgetter(3), reverse=True)
-    index.insert(0, ["id", "title", "tags", "modified"])
+        else:
+            count_update += 1
     return index, count_new, count_update
 
 
-def get_links(filelist, linklist=None):
+LINKS_HEADER = ["from", "to", "fromtitle"]
+BACKLINKS_HEADER = ["to", "from", "fromtitle"]
+
+
+class LinkTable(object):
+    '''
+    Tabela de links em memória, como lista de adjacência indexada pela
+    nota de origem, com mapa reverso indexado pela nota de destino.
+    Substituir os links de saída de uma nota é O(grau da nota).
+    '''
+    def __init__(self):
+        # id de origem -> [fromtitle, lista de destinos]
+        self.sources = {}
+        # id de destino -> conjunto de ids de origem
+        self.targets = {}
+        # origens e destinos alterados desde a última gravação em shards
+        self.touched_sources = set()
+        self.touched_targets = set()
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''
+        Cria tabela a partir de lista de listas (com header), como lida
+        de `.links.zkdata`
+        '''
+        table = cls()
+        for row in islice(rows, 1, None):
+            source, target, fromtitle = row[0], row[1], row[2]
+            entry = table.sources.get(source)
+            if entry is None:
+                entry = table.sources[source] = [fromtitle, []]
+            entry[1].append(target)
+            table.targets.setdefault(target, set()).add(source)
+        return table
+
+    def __len__(self):
+        return sum(len(entry[1]) for entry in self.sources.values())
+
+    def copy(self):
+        '''
+        Retorna cópia que pode ser alterada sem afetar esta tabela
+        '''
+        table = LinkTable()
+        table.sources = dict(self.sources)
+        table.targets = dict((target, set(ids)) for target, ids in self.targets.items())
+        table.touched_sources = set(self.touched_sources)
+        table.touched_targets = set(self.touched_targets)
+        return table
+
+    def remove(self, source):
+        '''
+        Remove links de saída de `source`
+        '''
+        entry = self.sources.pop(source, None)
+        if entry is None:
+            return
+        self.touched_sources.add(source)
+        self.touched_targets.update(entry[1])
+        for target in entry[1]:
+            linking = self.targets.get(target)
+            if linking is not None:
+                linking.discard(source)
+                if not linking:
+                    del self.targets[target]
+
+    def replace(self, source, fromtitle, targets):
+        '''
+        Substitui links de saída de `source` por `targets`
+        '''
+        self.remove(source)
+        if not targets:
+            return
+        self.sources[source] = [fromtitle, list(targets)]
+        self.touched_sources.add(source)
+        self.touched_targets.update(targets)
+        for target in targets:
+            self.targets.setdefault(target, set()).add(source)
+
+    def iter_rows(self, sources=None):
+        '''
+        Gera as linhas de `rows` uma a uma (tuplas), para gravar sem montar
+        a lista inteira
+        '''
+        yield LINKS_HEADER
+        if sources is None:
+            sources = self.sources
+        for source in sources:
+            fromtitle, targets = self.sources[source]
+            for target in targets:
+                yield (source, target, fromtitle)
+
+    def rows(self, sources=None):
+        '''
+        Retorna lista de listas com header (layout de `.links.zkdata`).
+        Se `sources` é fornecido, inclui apenas links dessas notas.
+        '''
+        return [list(row) for row in self.iter_rows(sources)]
+
+    def iter_backlink_rows(self, targets=None):
+        '''
+        Gera as linhas de `backlink_rows` uma a uma (tuplas)
+        '''
+        yield BACKLINKS_HEADER
+        if targets is None:
+            targets = self.targets
+        for target in sorted(targets):
+            for source in sorted(self.targets[target]):
+                yield (target, source, self.sources[source][0])
+
+    def backlink_rows(self, targets=None):
+        '''
+        Retorna lista de listas com header (layout de `.backlinks.zkdata`),
+        ordenada pela nota de destino.
+        Se `targets` é fornecido, inclui apenas links para essas notas.
+        '''
+        return [list(row) for row in self.iter_backlink_rows(targets)]
+
+
+@measured("read_links")
+def read_links(folder):
+    '''
+    Lê `.links.zkdata` em `folder` e retorna LinkTable
+    '''
+    with open(os.path.join(folder, ".links.zkdata"), 'r', encoding='utf-8') as file:
+        return LinkTable.from_rows(csv.reader(file))
+
+
+@measured("write_links")
+def write_links(linktable, folder):
+    '''
+    Grava LinkTable em `.links.zkdata` e o índice de backlinks (links
+    indexados pela nota de destino) em `.backlinks.zkdata`
+    '''
+    bump_generation()
+    with replacing(os.path.join(folder, ".links.zkdata"), newline="", encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerows(linktable.iter_rows())
+    with replacing(os.path.join(folder, ".backlinks.zkdata"), newline="", encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerows(linktable.iter_backlink_rows())
+
+
+@measured("read_backlinks")
+def read_backlinks(folder):
+    '''
+    Lê `.backlinks.zkdata` em `folder` e retorna dict id de destino ->
+    lista de pares (id de origem, título da origem). Se o arquivo ainda
+    não existe, usa `.links.zkdata`.
+    '''
+    filename = os.path.join(folder, ".backlinks.zkdata")
+    if not os.path.exists(filename):
+        rows = read_links(folder).backlink_rows()
+    else:
+        with open(filename, 'r', encoding='utf-8') as file:
+            rows = list(csv.reader(file))
+    backlinks = {}
+    for target, source, fromtitle in islice(rows, 1, None):
+        backlinks.setdefault(target, []).append((source, fromtitle))
+    return backlinks
+
+
+@measured("get_links", count_files)
+def get_links(filelist, linklist=None, notes=None, workers=1, chunksize=PARALLEL_CHUNKSIZE, hashes=None):
     '''
     Loop por `filelist` e coleta links para outras notas. Além dos links no 
     formato wiki `[[201901131249]]`, também identifica links com o formato 
     `@citekey` para notas bibliográficas.
-    Retorna lista de listas com colunas 'from', 'to', 'fromtitle'. 
-    Caso a lista de listas `linklist` seja fornecida, links são acrescentados ou removidos.
+    Retorna LinkTable (linhas com colunas 'from', 'to', 'fromtitle'). 
+    Caso uma LinkTable `linklist` (ou lista de listas com header) seja
+    fornecida, os links das notas em `filelist` são substituídos.
+    Se um dict `notes` é fornecido, registra nele a Note de cada arquivo lido.
+    `workers`, `chunksize` e `hashes` são repassados para `read_notes`
+    (notas com conteúdo inalterado são ignoradas).
     ''' 
     if linklist is None:
-        linklist = []
-    else:
-        #remove header
-        del linklist[0]
-    for file in filelist:
-        text = open(file, "r", encoding="utf8").read()
-        id = re.findall(r"id:\s*(\d{12}|[^\s\d]+\d{4}\w*)", text)[0]
-        fromtitle =  re.findall(r"\ntitle:\s*(.*)\n", text)[0].strip("'").strip('"')
-        # Exclui da linklist os registros anteriores desta nota
-        linklist = [item for item in linklist if not item[0]==id]
-        found_links = re.findall(r"(?<=\[\[)\s*\d{12}\s*(?=\]\])|(?<=@)[^\s\d]+\d{4}\w*", text)
-        if len(found_links) > 0:
-            for link in list(set(found_links)):
-                # Ignora referências à própria nota (geralmente em notas bibliográficas)
-                if link != id:
-                    linklist.append([id, link, fromtitle])
-    linklist.insert(0, ["from","to", "fromtitle"])
+        linklist = LinkTable()
+    elif not isinstance(linklist, LinkTable):
+        linklist = LinkTable.from_rows(linklist)
+    for file, note in zip(filelist, read_notes(filelist, True, workers, chunksize, hashes)):
+        if note is None:
+            continue
+        if notes is not None:
+            notes[file] = note
+        # Substitui registros anteriores desta nota
+        linklist.replace(note.id, note.title, note.links)
     return linklist
 
-def log(folder, count_new=0, count_update=0, links=False):
+def log(folder, count_new=0, count_update=0, links=False, count_deleted=0, now=None):
     '''
-    Registra operação em log file e timestamp
+    Registra operação em log file e timestamp.
+    `now` é o momento em que a atualização começou (antes de percorrer as
+    notas), para que notas salvas durante a atualização não sejam perdidas.
     '''
-    now = time.time()
+    if now is None:
+        now = time.time()
     now_string = time.strftime("%Y-%m-%d %H:%M:%S - ", time.localtime(now))
 
     if links:
-        timestamp = open(os.path.join(folder, ".links.zktimestamp"), "w", encoding="utf8")
+        write_timestamp(folder, "links", now)
         message = now_string + "Links atualizados"
     else:
-        timestamp = open(os.path.join(folder, ".index.zktimestamp"), "w", encoding="utf8")
+        write_timestamp(folder, "index", now)
         message = "\n" + now_string + str(count_new) + " notas novas, " + str(count_update) + " notas atualizadas"
-        if count_new > 0 or count_update > 0:
+        if count_deleted > 0:
+            message += ", " + str(count_deleted) + " notas removidas"
+        if count_new > 0 or count_update > 0 or count_deleted > 0:
             logfile = open(os.path.join(folder, ".zklog.txt"), "a", encoding="utf8")
             logfile.write(message)
             logfile.close()
 
-    timestamp.write(str(now))
-    timestamp.close()
     print(message)
 
+
+def write_timestamp(folder, name, now):
+    '''
+    Registra momento da última atualização em `.<name>.zktimestamp`
+    '''
+    with replacing(os.path.join(folder, "." + name + ".zktimestamp"), encoding="utf8") as timestamp:
+        timestamp.write(str(now))
+
 def index_android(index, folder):
     '''
     Cria índice para uso do aplicativo Epsilon notes no Android. 
@@ -155,53 +1223,1777 @@ def index_android(index, folder):
     contents = ('---\ntitle: Notas\n---\n'
                     '## Recentes:\n%s\n\n***\n'
                     '## [Busca](android-app://jp.sblo.pandora.aGrep)\n') % (string)
-    index_android = open(os.path.join(folder, ".index_android.txt"), "w", encoding="utf8")
-    index_android.write(contents)
-    index_android.close()
+    with replacing(os.path.join(folder, ".index_android.txt"), encoding="utf8") as index_android:
+        index_android.write(contents)
 
 
 # ----------------------------------------------------------
-# Funções de atualização
+# Índice de busca (texto completo)
 # ----------------------------------------------------------
 
-def update_index(notes_folder = None, index_folder = None, rebuild = False, get_body_tags = False):
-    if rebuild:
-        timestamp = 0
-        index_old = None
-    else:
-        timestamp = open(os.path.join(index_folder, ".index.zktimestamp"), "r").read()
-        timestamp = float(timestamp)
-        with open(os.path.join(index_folder, ".index.zkdata"), 'r', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            index_old = list(reader)
-    modified = get_modified_notes(notes_folder, timestamp)
-    if len(modified) > 0:
-        index, count_new, count_updated = get_notes_metadata(modified, index_old, get_body_tags)
-        with open(os.path.join(index_folder, ".index.zkdata"), "w+", newline="", encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerows(index)
-        index_android(index, notes_folder)
-    else:
-        count_new = 0
-        count_updated = 0
-    log(index_folder, count_new, count_updated)
+WORD = re.compile(r"\w+")
+# Caracteres que indicam que um termo de busca é uma regex
+# (e não pode ser respondido pelo índice)
+REGEX_CHARACTERS = re.compile(r"[.^$*+?{}\[\]\\|()]")
 
 
+def get_terms(text):
+    '''
+    Retorna dict com cada palavra (em minúsculas) de `text` -> lista de
+    posições (número de ordem da palavra no texto)
+    '''
+    terms = {}
+    for position, match in enumerate(WORD.finditer(text.lower())):
+        word = match.group()
+        positions = terms.get(word)
+        if positions is None:
+            terms[word] = [position]
+        else:
+            positions.append(position)
+    return terms
 
-def update_links(notes_folder, index_folder, rebuild = False):
-    if rebuild:
-        timestamp = 0
-        linklist_old = None
-    else:
-        timestamp = open(os.path.join(index_folder, ".links.zktimestamp"), "r").read()
-        timestamp = float(timestamp)
-        with open(os.path.join(index_folder, ".links.zkdata"), 'r', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            linklist_old = list(reader)
-    modified = get_modified_notes(notes_folder, timestamp)
-    if len(modified) > 0:
-        linklist = get_links(modified, linklist_old)
-        with open(os.path.join(index_folder, ".links.zkdata"), "w+", newline="", encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerows(linklist)
-    log(index_folder, 0, 0, True)
\ No newline at end of file
+
+# Parâmetros do BM25 (ordenação dos resultados por relevância) e peso extra
+# de palavras da busca que aparecem no título ou nas tags da nota
+BM25_K1 = 1.2
+BM25_B = 0.75
+TITLE_BOOST = 2.0
+TAG_BOOST = 1.5
+
+
+def is_plain_term(term):
+    '''
+    Checa se termo de busca pode ser respondido pelo índice (não é regex)
+    '''
+    return REGEX_CHARACTERS.search(term) is None and WORD.search(term) is not None
+
+
+class SearchIndex(object):
+    '''
+    Índice invertido do texto das notas: termo -> notas e posições em que
+    aparece. Mantém também o mapa inverso (nota -> termos), para que uma
+    nota possa ser atualizada ou removida sem percorrer todo o índice.
+    '''
+    def __init__(self):
+        # id -> {termo: [posições]}
+        self.notes = {}
+        # termo -> {id: [posições]}
+        self.postings = {}
+        # Lista ordenada de termos, para busca por prefixo (criada sob demanda)
+        self.vocabulary = None
+        # id -> número de palavras da nota, e soma para todas as notas (BM25)
+        self.lengths = {}
+        self.total_length = 0
+        # ids alterados desde a última gravação (ver write_search_index)
+        self.touched = set()
+        # Termos cujas notas (postings[termo]) ainda são compartilhadas com o
+        # índice de que este é cópia, e não podem ser alteradas no lugar
+        self.shared = set()
+
+    @classmethod
+    def from_notes(cls, notes):
+        index = cls()
+        for id, terms in notes.items():
+            index.set_note(id, terms)
+        index.touched.clear()
+        return index
+
+    def __len__(self):
+        return len(self.notes)
+
+    def copy(self):
+        '''
+        Retorna cópia que pode ser alterada sem afetar este índice.
+        As notas de cada termo só são copiadas quando alteradas: copiar o
+        índice inteiro a cada nota salva seria lento em pastas grandes.
+        '''
+        index = SearchIndex()
+        index.notes = dict(self.notes)
+        index.postings = dict(self.postings)
+        index.vocabulary = self.vocabulary
+        index.lengths = dict(self.lengths)
+        index.total_length = self.total_length
+        index.touched = set(self.touched)
+        index.shared = set(self.postings)
+        return index
+
+    def own_postings(self, term):
+        '''
+        Retorna as notas de `term` (existente), copiando-as antes se ainda
+        são compartilhadas com outro índice
+        '''
+        postings = self.postings[term]
+        if term in self.shared:
+            self.shared.discard(term)
+            postings = self.postings[term] = dict(postings)
+        return postings
+
+    def remove(self, id):
+        '''
+        Remove nota do índice. Retorna True se a nota existia.
+        '''
+        terms = self.notes.pop(id, None)
+        if terms is None:
+            return False
+        self.touched.add(id)
+        self.total_length -= self.lengths.pop(id)
+        for term in terms:
+            postings = self.own_postings(term)
+            del postings[id]
+            if not postings:
+                del self.postings[term]
+                self.vocabulary = None
+        return True
+
+    def set_note(self, id, terms):
+        '''
+        Acrescenta ou substitui os termos (dict termo -> posições) da nota `id`
+        '''
+        self.remove(id)
+        self.notes[id] = terms
+        self.touched.add(id)
+        length = 0
+        for term, positions in terms.items():
+            length += len(positions)
+            if term in self.postings:
+                postings = self.own_postings(term)
+            else:
+                postings = self.postings[term] = {}
+                self.vocabulary = None
+            postings[id] = positions
+        self.lengths[id] = length
+        self.total_length += length
+
+    def expand(self, prefix):
+        '''
+        Retorna termos do índice que começam com `prefix`
+        '''
+        if self.vocabulary is None:
+            self.vocabulary = sorted(self.postings)
+        start = bisect_left(self.vocabulary, prefix)
+        terms = []
+        for term in islice(self.vocabulary, start, None):
+            if not term.startswith(prefix):
+                break
+            terms.append(term)
+        return terms
+
+    def match_term(self, term):
+        '''
+        Retorna conjunto de ids das notas que contêm `term`.
+        Uma palavra é buscada como prefixo (`red` encontra `redes`); um termo
+        com várias palavras (ex.: "redes sociais") é buscado como frase, com
+        as palavras em sequência (a última também como prefixo).
+        '''
+        words = WORD.findall(term.lower())
+        if len(words) == 0:
+            return set()
+        if len(words) == 1:
+            ids = set()
+            for expanded in self.expand(words[0]):
+                ids.update(self.postings[expanded])
+            return ids
+        # notas que contêm todas as palavras; depois checa a sequência
+        candidates = []
+        for i, word in enumerate(words):
+            if i == len(words) - 1:
+                expanded = self.expand(word)
+            else:
+                expanded = [word] if word in self.postings else []
+            ids = set()
+            for candidate in expanded:
+                ids.update(self.postings[candidate])
+            candidates.append(ids)
+        candidates.sort(key=len)
+        ids = candidates[0]
+        for other in candidates[1:]:
+            ids.intersection_update(other)
+        return set(id for id in ids if self.phrase_positions(id, words))
+
+    def phrase_positions(self, id, words):
+        '''
+        Retorna posições em que a frase `words` começa na nota `id`
+        '''
+        terms = self.notes[id]
+        starts = set(terms.get(words[0], ()))
+        for offset, word in enumerate(words[1:], 1):
+            if offset == len(words) - 1:
+                found = set()
+                for expanded in self.expand(word):
+                    found.update(terms.get(expanded, ()))
+            else:
+                found = set(terms.get(word, ()))
+            starts = set(start for start in starts if start + offset in found)
+            if not starts:
+                break
+        return starts
+
+    def idf(self, count):
+        n = len(self.notes)
+        return math.log(1 + (n - count + 0.5) / (count + 0.5))
+
+    def rank(self, ids, terms, index=None, limit=None):
+        '''
+        Ordena `ids` (ex.: resultado de uma busca) por relevância para as
+        palavras de `terms`: BM25 sobre o texto das notas (cada palavra conta
+        também como prefixo, como em `match_term`), mais um peso extra para
+        palavras que aparecem no título ou nas tags da nota (se o NoteIndex
+        `index` é fornecido; ele também desempata, com as notas mais
+        recentes primeiro).
+        Retorna lista com os `limit` ids mais relevantes (None = todos),
+        escolhidos com heap, sem ordenar todos os resultados.
+        '''
+        scores = dict.fromkeys(ids, 0.0)
+        if not scores:
+            return []
+        words = list(OrderedDict.fromkeys(word for term in terms for word in WORD.findall(term.lower())))
+        average = self.total_length / len(self.notes) if self.notes else 1.0
+        # parte do denominador do BM25 que só depende do tamanho da nota
+        norms = dict((id, BM25_K1 * (1 - BM25_B + BM25_B * self.lengths.get(id, 0) / average)) for id in scores)
+        if index is not None:
+            fields = {}
+            for id in scores:
+                record = index.get(id)
+                if record is not None:
+                    fields[id] = (" " + record.title.lower(),
+                                  [tag.lstrip("#") for tag in split_tags(record.tags.lower())])
+        for word in words:
+            count = 0
+            for term in self.expand(word):
+                postings = self.postings[term]
+                count += len(postings)
+                weight = self.idf(len(postings)) * (BM25_K1 + 1)
+                # percorre o menor entre notas com o termo e notas a ordenar
+                if len(postings) < len(norms):
+                    pairs = ((id, positions) for id, positions in postings.items() if id in norms)
+                else:
+                    pairs = ((id, postings[id]) for id in norms if id in postings)
+                for id, positions in pairs:
+                    frequency = len(positions)
+                    scores[id] += weight * frequency / (frequency + norms[id])
+            if index is not None:
+                # número de notas com a palavra (ou prefixo) aproximado pela soma
+                idf = self.idf(min(count, len(self.notes)))
+                start = " " + word
+                for id, (title, tags) in fields.items():
+                    if start in title:
+                        scores[id] += TITLE_BOOST * idf
+                    if any(tag.startswith(word) for tag in tags):
+                        scores[id] += TAG_BOOST * idf
+        if index is None:
+            key = scores.get
+        else:
+            records = index.records
+            key = lambda id: (scores[id], records[id].modified if id in records else 0)
+        if limit is None:
+            return sorted(scores, key=key, reverse=True)
+        return nlargest(limit, scores, key=key)
+
+
+# Índice de busca dividido em shards (um arquivo JSON por shard, com os
+# termos e posições de cada nota; mesmos shards de `note_shard`), para que
+# uma atualização leia e grave só os shards das notas alteradas.
+# `.search/search.zkdata` (número de notas por shard) é gravado por último.
+SEARCH_FOLDER = ".search"
+SEARCH_STAMP = os.path.join(SEARCH_FOLDER, "search.zkdata")
+SEARCH_HEADER = ["shard", "notes"]
+# Formato antigo: índice inteiro num único arquivo
+LEGACY_SEARCH_FILE = ".search.zkdata"
+
+
+def search_shard_path(folder, shard):
+    return os.path.join(folder, SEARCH_FOLDER, shard + ".json")
+
+
+def read_search_stamp(folder):
+    '''
+    Lê `.search/search.zkdata` e retorna dict shard -> número de notas,
+    ou None se não existe
+    '''
+    filename = os.path.join(folder, SEARCH_STAMP)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r', encoding='utf-8') as file:
+        return dict((shard, int(notes)) for shard, notes in islice(csv.reader(file), 1, None))
+
+
+@measured("read_search_index")
+def read_search_index(folder, shards=None):
+    '''
+    Lê índice de busca em `folder` (todos os shards, ou só os em `shards`)
+    e retorna SearchIndex (vazio, se o índice não existe). O formato antigo
+    (`.search.zkdata`) é lido por inteiro, e convertido na próxima gravação.
+    '''
+    stamp = read_search_stamp(folder)
+    if stamp is None:
+        filename = os.path.join(folder, LEGACY_SEARCH_FILE)
+        if not os.path.exists(filename):
+            return SearchIndex()
+        with open(filename, 'r', encoding='utf-8') as file:
+            return SearchIndex.from_notes(json.load(file))
+    notes = {}
+    for shard in sorted(stamp):
+        if shards is not None and shard not in shards:
+            continue
+        with open(search_shard_path(folder, shard), 'r', encoding='utf-8') as file:
+            notes.update(json.load(file))
+    return SearchIndex.from_notes(notes)
+
+
+@measured("write_search_index")
+def write_search_index(index, folder, full=False):
+    '''
+    Grava shards do índice de busca alterados desde a última gravação
+    (`index.touched`); com `full` = True (ou se ainda não há shards), todos.
+    Os shards alterados precisam ter sido lidos por inteiro em `index`.
+    '''
+    bump_generation()
+    stamp = read_search_stamp(folder)
+    full = full or stamp is None
+    if full:
+        groups = group_by_shard(index.notes)
+        counts = {}
+    else:
+        groups = group_by_shard(index.notes, set(note_shard(id) for id in index.touched))
+        for id in index.touched:
+            groups.setdefault(note_shard(id), [])
+        counts = stamp
+    os.makedirs(os.path.join(folder, SEARCH_FOLDER), exist_ok=True)
+    for shard, ids in groups.items():
+        filename = search_shard_path(folder, shard)
+        if len(ids) > 0:
+            # json.dumps usa o codificador em C (json.dump, não)
+            with replacing(filename, encoding='utf-8') as file:
+                file.write(json.dumps(dict((id, index.notes[id]) for id in sorted(ids)),
+                                      ensure_ascii=False, separators=(",", ":")))
+            counts[shard] = len(ids)
+        else:
+            if os.path.exists(filename):
+                os.remove(filename)
+            counts.pop(shard, None)
+    if full:
+        for name in os.listdir(os.path.join(folder, SEARCH_FOLDER)):
+            if name.endswith(".json") and name[:-len(".json")] not in counts:
+                os.remove(os.path.join(folder, SEARCH_FOLDER, name))
+        if os.path.exists(os.path.join(folder, LEGACY_SEARCH_FILE)):
+            os.remove(os.path.join(folder, LEGACY_SEARCH_FILE))
+    with replacing(os.path.join(folder, SEARCH_STAMP), newline="", encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(SEARCH_HEADER)
+        for shard in sorted(counts):
+            writer.writerow([shard, counts[shard]])
+    index.touched.clear()
+
+
+# ----------------------------------------------------------
+# Consultas estruturadas
+# ----------------------------------------------------------
+
+# Sintaxe (termos separados por espaço, frases entre aspas):
+#   redes "efeito causal"   texto da nota (palavra como prefixo; frase em sequência)
+#   tag:#metodo             notas com a tag
+#   link:201901131249       notas que linkam para a nota
+#   cites:@silva2019        notas que citam a referência
+#   title:redes             título com palavra começando por "redes"
+#   date:2019..202003       id (data de criação) no intervalo; um lado pode
+#                           ficar vazio (date:2019.., date:..2019) e date:2019
+#                           equivale a date:2019..2019
+#   #metodo, @silva2019     o mesmo que tag:#metodo e cites:@silva2019
+#   -termo                  exclui notas com o termo (qualquer um dos acima)
+#   a b OR c                notas com a e b, ou com c (OR separa grupos de termos)
+# Termos de texto que são regex não podem ser respondidos pelo índice: são
+# checados por último, lendo só os arquivos das notas que restaram.
+Predicate = namedtuple("Predicate", ["field", "value", "negated"])
+QUERY_FIELDS = ("tag", "link", "cites", "title", "date")
+DATE_ID = re.compile(r"^\d{12}$")
+# Tags e citekeys como reconhecidas no texto das notas (ver TOKEN)
+QUERY_TAG = re.compile(r"\#\w+\.?\w+")
+QUERY_CITEKEY = re.compile(r"@[^\s\d]+\d{4}\w*")
+
+
+def parse_predicate(token):
+    negated = token.startswith("-") and len(token) > 1
+    if negated:
+        token = token[1:]
+    field, separator, value = token.partition(":")
+    if separator and field in QUERY_FIELDS and value:
+        if field == "tag" and not value.startswith("#"):
+            value = "#" + value
+        elif field == "link":
+            value = value.strip("[]")
+        elif field == "cites":
+            value = value.lstrip("@")
+        elif field == "title":
+            value = normalize_text(value)
+        elif field == "date":
+            start, separator, end = value.partition("..")
+            value = (start, end if separator else start)
+        return Predicate(field, value, negated)
+    # o índice de texto guarda só as palavras (sem # e @): tags e citekeys
+    # soltas são buscadas nos índices de tags e de links, e outros termos
+    # com # ou @ são checados literalmente nos arquivos
+    if QUERY_TAG.fullmatch(token) is not None:
+        return Predicate("tag", token, negated)
+    if QUERY_CITEKEY.fullmatch(token) is not None:
+        return Predicate("cites", token[1:], negated)
+    if token[:1] in ("#", "@"):
+        return Predicate("regex", re.escape(token), negated)
+    return Predicate("text" if is_plain_term(token) else "regex", token, negated)
+
+
+def parse_query(text):
+    '''
+    Retorna lista de grupos (alternativas ligadas por OR), cada um uma lista
+    de Predicate(field, value, negated) que devem valer ao mesmo tempo
+    '''
+    lexer = shlex.shlex(text, posix=True)
+    lexer.whitespace_split = True
+    # mantém barras invertidas (regex) e # (tags)
+    lexer.escape = ""
+    lexer.commenters = ""
+    groups = [[]]
+    for token in lexer:
+        if token == "OR":
+            groups.append([])
+        else:
+            groups[-1].append(parse_predicate(token))
+    return [group for group in groups if group]
+
+
+def in_date_range(id, bounds):
+    '''
+    Checa se o id (AAAAMMDDhhmm) está no intervalo `bounds` (início, fim),
+    comparando só o número de dígitos de cada limite
+    '''
+    if DATE_ID.match(id) is None:
+        return False
+    start, end = bounds
+    return id[:len(start)] >= start and id[:len(end)] <= end
+
+
+class QueryPlan(object):
+    '''
+    Executa consulta (ver `parse_query`) com os índices em memória: cada
+    grupo começa pelas listas de notas dos índices (tags, backlinks e
+    texto), da menor para a maior, interrompendo a interseção quando não
+    sobra nenhuma nota; título, data e exclusões filtram as notas que
+    restaram, e regex são checadas por último, lendo só esses arquivos.
+    `backlinks` é uma função id -> ids das notas que linkam para ele;
+    `paths` é um dict id -> caminho do arquivo (só usado para regex).
+    '''
+    def __init__(self, index, search, backlinks, paths=None):
+        self.index = index
+        self.search = search
+        self.backlinks = backlinks
+        self.paths = paths
+
+    def estimate(self, predicate):
+        '''
+        Número estimado de notas do predicado, sem montar a lista
+        '''
+        if predicate.field == "tag":
+            return len(self.index.tags.get(predicate.value, ()))
+        if predicate.field in ("link", "cites"):
+            return len(self.backlinks(predicate.value))
+        words = WORD.findall(predicate.value.lower())
+        postings = self.search.postings
+        # palavra menos frequente (a última pode ser prefixo)
+        return min(sum(len(postings[term]) for term in self.search.expand(word)) if i == len(words) - 1
+                   else len(postings.get(word, ())) for i, word in enumerate(words))
+
+    def notes(self, predicate):
+        '''
+        Conjunto de ids das notas do predicado (tag, link, cites ou texto)
+        '''
+        if predicate.field == "tag":
+            return set(self.index.tags.get(predicate.value, ()))
+        if predicate.field in ("link", "cites"):
+            return set(self.backlinks(predicate.value))
+        return self.search.match_term(predicate.value)
+
+    def matches(self, predicate, id):
+        '''
+        Checa predicado de título ou data para uma nota
+        '''
+        if predicate.field == "title":
+            record = self.index.get(id)
+            return record is not None and (" " + predicate.value) in (" " + normalize_text(record.title))
+        return in_date_range(id, predicate.value)
+
+    def scan(self, ids, predicates):
+        '''
+        Gera as notas cujo arquivo satisfaz as regex, à medida que os
+        arquivos são lidos (busca sem diferenciar maiúsculas, a não ser
+        que a regex tenha alguma)
+        '''
+        patterns = [(re.compile(predicate.value, 0 if predicate.value.lower() != predicate.value else re.IGNORECASE),
+                     predicate.negated) for predicate in predicates]
+        for id in ids:
+            path = self.paths.get(id) if self.paths is not None else None
+            if path is None:
+                continue
+            try:
+                with open(path, encoding="utf8") as file:
+                    text = file.read()
+            except OSError:
+                continue
+            if all((pattern.search(text) is None) == negated for pattern, negated in patterns):
+                yield id
+
+    def run_group(self, group):
+        '''
+        Gera as notas que satisfazem o grupo (as que dependem de regex, à
+        medida que os arquivos são lidos)
+        '''
+        sources = [predicate for predicate in group
+                   if not predicate.negated and predicate.field in ("tag", "link", "cites", "text")]
+        sources.sort(key=self.estimate)
+        ids = None
+        for predicate in sources:
+            notes = self.notes(predicate)
+            ids = notes if ids is None else ids & notes
+            if not ids:
+                return
+        if ids is None:
+            ids = set(self.index.records)
+        for predicate in group:
+            if predicate.field in ("title", "date"):
+                ids = set(id for id in ids if self.matches(predicate, id) != predicate.negated)
+            elif predicate.negated and predicate.field != "regex":
+                ids -= self.notes(predicate)
+        regex = [predicate for predicate in group if predicate.field == "regex"]
+        if regex and ids:
+            ids = self.scan(ids, regex)
+        for id in ids:
+            yield id
+
+    def stream(self, groups):
+        '''
+        Gera (sem repetir) as notas que satisfazem algum dos grupos, à
+        medida que são encontradas
+        '''
+        found = set()
+        for group in groups:
+            for id in self.run_group(group):
+                if id not in found:
+                    found.add(id)
+                    yield id
+
+    def run(self, groups):
+        '''
+        Retorna conjunto de ids das notas que satisfazem algum dos grupos
+        '''
+        return set(self.stream(groups))
+
+
+def query_terms(groups):
+    '''
+    Termos de texto e de título (não excluídos) da consulta, para ordenar
+    os resultados por relevância
+    '''
+    return [predicate.value for group in groups for predicate in group
+            if not predicate.negated and predicate.field in ("text", "title")]
+
+
+def note_paths(notes_folder, index_folder):
+    '''
+    Retorna dict id -> caminho do arquivo de cada nota (do manifesto do índice)
+    '''
+    manifest = read_manifest(index_folder, "index") or {}
+    return dict((entry[3], os.path.join(notes_folder, path)) for path, entry in manifest.items())
+
+
+# ----------------------------------------------------------
+# Índice de trigramas (completar títulos)
+# ----------------------------------------------------------
+
+# Proporção mínima dos trigramas da consulta que um texto precisa ter
+# para aparecer entre os resultados
+TRIGRAM_MIN_SHARE = 0.5
+
+
+def normalize_text(text):
+    '''
+    Texto em minúsculas, sem acentos e com palavras separadas por um espaço
+    '''
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(character for character in text if not unicodedata.combining(character))
+    return " ".join(WORD.findall(text))
+
+
+def get_trigrams(text):
+    '''
+    Conjunto de trigramas de texto já normalizado (com espaço no início e
+    no fim, para que começos e fins de palavras também contem)
+    '''
+    text = " " + text + " "
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class TrigramIndex(object):
+    '''
+    Índice de trigramas de textos curtos (ex.: "id título" de cada nota), para
+    busca aproximada: tolera erros de digitação, palavras fora de ordem e
+    palavras incompletas. Textos podem ser acrescentados, alterados e
+    removidos um a um (ou sincronizados com `sync`).
+    '''
+    def __init__(self):
+        # chave -> (texto original, texto normalizado)
+        self.texts = {}
+        # trigrama -> conjunto de chaves
+        self.grams = {}
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, key, text):
+        current = self.texts.get(key)
+        if current is not None:
+            if current[0] == text:
+                return
+            self.remove(key)
+        normalized = normalize_text(text)
+        self.texts[key] = (text, normalized)
+        for gram in get_trigrams(normalized):
+            self.grams.setdefault(gram, set()).add(key)
+
+    def remove(self, key):
+        current = self.texts.pop(key, None)
+        if current is None:
+            return
+        for gram in get_trigrams(current[1]):
+            keys = self.grams[gram]
+            keys.discard(key)
+            if not keys:
+                del self.grams[gram]
+
+    def sync(self, items):
+        '''
+        Atualiza índice para conter exatamente os pares (chave, texto) de
+        `items`, reindexando só os textos novos ou alterados
+        '''
+        keys = set()
+        for key, text in items:
+            keys.add(key)
+            self.add(key, text)
+        for key in [key for key in self.texts if key not in keys]:
+            self.remove(key)
+
+    def search(self, query, limit=20):
+        '''
+        Retorna lista de até `limit` pares (chave, texto) mais parecidos com
+        `query`: primeiro os que têm mais trigramas da consulta; entre eles,
+        os que contêm a consulta inteira e, por fim, os mais curtos
+        '''
+        query = normalize_text(query)
+        if not query:
+            return []
+        if len(query) < 3:
+            # consulta curta demais para trigramas: começo de palavra
+            start = " " + query
+            matches = [key for key, (text, normalized) in self.texts.items()
+                       if normalized.startswith(query) or start in normalized]
+            return [(key, self.texts[key][0]) for key in
+                    nsmallest(limit, matches, key=lambda key: len(self.texts[key][1]))]
+        grams = get_trigrams(query)
+        counts = Counter()
+        for gram in grams:
+            keys = self.grams.get(gram)
+            if keys:
+                counts.update(keys)
+        needed = max(1, math.ceil(len(grams) * TRIGRAM_MIN_SHARE))
+        texts = self.texts
+        best = nlargest(limit, (key for key, count in counts.items() if count >= needed),
+                        key=lambda key: (counts[key], query in texts[key][1], -len(texts[key][1])))
+        return [(key, texts[key][0]) for key in best]
+
+
+# ----------------------------------------------------------
+# Armazenamento SQLite (opcional)
+# ----------------------------------------------------------
+
+DB_FILE = ".index.zkdb"
+
+DB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS notes (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    modified REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notes_modified ON notes (modified DESC);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT NOT NULL,
+    note_id TEXT NOT NULL,
+    PRIMARY KEY (tag, note_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tags_note ON tags (note_id);
+CREATE TABLE IF NOT EXISTS links (
+    source TEXT NOT NULL,
+    target TEXT NOT NULL,
+    fromtitle TEXT NOT NULL,
+    PRIMARY KEY (source, target)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS links_target ON links (target);
+CREATE TABLE IF NOT EXISTS populated (
+    name TEXT PRIMARY KEY
+);
+'''
+
+
+def has_db(folder, table):
+    '''
+    Checa se o banco existe e se `table` ("notes" ou "links") já foi
+    preenchida por completo ao menos uma vez
+    '''
+    if not os.path.exists(os.path.join(folder, DB_FILE)):
+        return False
+    return len(query_db(folder, "SELECT name FROM populated WHERE name = ?", (table,))) > 0
+
+
+def connect_db(folder, readonly=False):
+    '''
+    Abre (e cria, se necessário) banco SQLite do índice em `folder`,
+    em modo WAL. Com `readonly` = True (consultas), abre o banco existente
+    só para leitura, sem criar as tabelas.
+    '''
+    if sqlite3 is None:
+        raise RuntimeError("Módulo sqlite3 não disponível nesta instalação de Python")
+    filename = os.path.join(folder, DB_FILE)
+    if readonly:
+        return sqlite3.connect("file:%s?mode=ro" % pathname2url(filename), uri=True)
+    conn = sqlite3.connect(filename)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(DB_SCHEMA)
+    return conn
+
+
+@measured("write_db_index")
+def write_db_index(index, folder, ids=None, removed=()):
+    '''
+    Grava NoteIndex nas tabelas `notes` e `tags`, numa única transação.
+    Se `ids` é fornecido, apenas essas notas são regravadas (e as notas em
+    `removed` apagadas); caso contrário, as tabelas são recriadas.
+    '''
+    bump_generation()
+    conn = connect_db(folder)
+    try:
+        with conn:
+            if ids is None:
+                conn.execute("DELETE FROM notes")
+                conn.execute("DELETE FROM tags")
+                conn.execute("INSERT OR IGNORE INTO populated VALUES ('notes')")
+                records = index.records.values()
+            else:
+                stale = [(id,) for id in set(ids).union(removed)]
+                conn.executemany("DELETE FROM notes WHERE id = ?", stale)
+                conn.executemany("DELETE FROM tags WHERE note_id = ?", stale)
+                records = [index.get(id) for id in set(ids)]
+                records = [record for record in records if record is not None]
+            conn.executemany("INSERT INTO notes VALUES (?, ?, ?, ?)",
+                             [record.as_row() for record in records])
+            conn.executemany("INSERT OR IGNORE INTO tags VALUES (?, ?)",
+                             [(tag, record.id) for record in records for tag in split_tags(record.tags)])
+    finally:
+        conn.close()
+
+
+def read_db_index(folder):
+    '''
+    Lê tabela `notes` e retorna NoteIndex
+    '''
+    conn = connect_db(folder, True)
+    try:
+        index = NoteIndex()
+        for id, title, tags, modified in conn.execute("SELECT id, title, tags, modified FROM notes"):
+            index.upsert(id, title, tags, modified)
+        index.touched.clear()
+    finally:
+        conn.close()
+    return index
+
+
+@measured("write_db_links")
+def write_db_links(linktable, folder, ids=None):
+    '''
+    Grava LinkTable na tabela `links`, numa única transação.
+    Se `ids` é fornecido, apenas os links de saída dessas notas são regravados;
+    caso contrário, a tabela é recriada.
+    '''
+    bump_generation()
+    conn = connect_db(folder)
+    try:
+        with conn:
+            if ids is None:
+                conn.execute("DELETE FROM links")
+                conn.execute("INSERT OR IGNORE INTO populated VALUES ('links')")
+                sources = list(linktable.sources)
+            else:
+                sources = list(set(ids))
+                conn.executemany("DELETE FROM links WHERE source = ?", [(id,) for id in sources])
+            rows = []
+            for source in sources:
+                entry = linktable.sources.get(source)
+                if entry is not None:
+                    rows.extend((source, target, entry[0]) for target in entry[1])
+            conn.executemany("INSERT OR IGNORE INTO links VALUES (?, ?, ?)", rows)
+    finally:
+        conn.close()
+
+
+def read_db_links(folder):
+    '''
+    Lê tabela `links` e retorna LinkTable
+    '''
+    conn = connect_db(folder, True)
+    try:
+        rows = conn.execute("SELECT source, target, fromtitle FROM links").fetchall()
+    finally:
+        conn.close()
+    rows.insert(0, LINKS_HEADER)
+    return LinkTable.from_rows(rows)
+
+
+@measured("query_db")
+def query_db(folder, sql, params=()):
+    conn = connect_db(folder, True)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def db_note_list(folder):
+    '''
+    Retorna lista "id title" de todas as notas, das mais recentes para as
+    mais antigas
+    '''
+    return [id + " " + title for id, title in
+            query_db(folder, "SELECT id, title FROM notes ORDER BY modified DESC")]
+
+
+def db_tag_list(folder):
+    '''
+    Retorna lista ordenada de tags distintas
+    '''
+    return [row[0] for row in query_db(folder, "SELECT DISTINCT tag FROM tags ORDER BY tag")]
+
+
+def db_tag_counts(folder):
+    '''
+    Retorna lista de pares (tag, número de notas), em ordem alfabética
+    '''
+    return query_db(folder, "SELECT tag, COUNT(*) FROM tags GROUP BY tag ORDER BY tag")
+
+
+def db_notes_by_tag(folder, tag):
+    '''
+    Retorna lista "id title" das notas com a tag fornecida
+    '''
+    sql = ("SELECT notes.id, notes.title FROM tags JOIN notes ON notes.id = tags.note_id "
+           "WHERE tags.tag = ? ORDER BY notes.modified DESC")
+    return [id + " " + title for id, title in query_db(folder, sql, (tag,))]
+
+
+def db_notes_by_link(folder, id):
+    '''
+    Retorna lista "id fromtitle" das notas que linkam para o id fornecido
+    '''
+    sql = "SELECT source, fromtitle FROM links WHERE target = ?"
+    return [source + " " + fromtitle for source, fromtitle in query_db(folder, sql, (id,))]
+
+
+def db_note_title(folder, id):
+    '''
+    Retorna título da nota com o id fornecido (ou None)
+    '''
+    rows = query_db(folder, "SELECT title FROM notes WHERE id = ?", (id,))
+    if len(rows) == 0:
+        return None
+    return rows[0][0]
+
+
+# ----------------------------------------------------------
+# Armazenamento em shards (opcional)
+# ----------------------------------------------------------
+
+# Índice e links divididos em arquivos menores (um por mês de criação das
+# notas), para que uma atualização regrave só os arquivos alterados:
+#   .shards/index/<shard>.csv      notas (layout de `.index.zkdata`)
+#   .shards/links/<shard>.csv      links, pelo shard da nota de origem
+#   .shards/backlinks/<shard>.csv  backlinks, pelo shard da nota de destino
+#   .shards/shards.zkdata          shards existentes e número de linhas
+# Os CSVs únicos podem ser exportados com `export_flat` (ex.: para o app em R).
+SHARDS_FOLDER = ".shards"
+SHARDS_STAMP = os.path.join(SHARDS_FOLDER, "shards.zkdata")
+SHARDS_HEADER = ["kind", "shard", "rows"]
+BIBLIO_SHARD = "biblio"
+
+
+def note_shard(id):
+    '''
+    Shard de uma nota: prefixo AAAAMM do id. Notas de fichamento (id é a
+    citekey) e outras com id fora do padrão ficam no shard "biblio".
+    '''
+    if len(id) == 12 and id.isdigit():
+        return id[:6]
+    return BIBLIO_SHARD
+
+
+def shard_path(folder, kind, shard):
+    return os.path.join(folder, SHARDS_FOLDER, kind, shard + ".csv")
+
+
+def read_shard_stamp(folder):
+    '''
+    Lê `.shards/shards.zkdata` e retorna dict tipo ("index", "links" ou
+    "backlinks") -> {shard: número de linhas}, ou None se não existe
+    '''
+    filename = os.path.join(folder, SHARDS_STAMP)
+    if not os.path.exists(filename):
+        return None
+    stamp = {}
+    with open(filename, 'r', encoding='utf-8') as file:
+        for kind, shard, rows in islice(csv.reader(file), 1, None):
+            stamp.setdefault(kind, {})[shard] = int(rows)
+    return stamp
+
+
+def has_shards(folder, kind):
+    '''
+    Checa se os shards de `kind` já foram gravados por completo ao menos uma vez
+    '''
+    stamp = read_shard_stamp(folder)
+    return stamp is not None and kind in stamp
+
+
+def write_shards(folder, kind, shards, rows_for, full):
+    '''
+    Grava arquivos de `kind` para cada shard em `shards`, com linhas
+    `rows_for(shard)` (com header); shards sem linhas são apagados.
+    Com `full` = True, apaga também shards antigos que não estão em `shards`.
+    '''
+    stamp = read_shard_stamp(folder) or {}
+    counts = {} if full else stamp.get(kind, {})
+    os.makedirs(os.path.join(folder, SHARDS_FOLDER, kind), exist_ok=True)
+    for shard in shards:
+        rows = rows_for(shard)
+        filename = shard_path(folder, kind, shard)
+        if len(rows) > 1:
+            with replacing(filename, newline="", encoding='utf-8') as file:
+                csv.writer(file).writerows(rows)
+            counts[shard] = len(rows) - 1
+        else:
+            if os.path.exists(filename):
+                os.remove(filename)
+            counts.pop(shard, None)
+    if full:
+        for name in os.listdir(os.path.join(folder, SHARDS_FOLDER, kind)):
+            if name.endswith(".csv") and name[:-len(".csv")] not in counts:
+                os.remove(os.path.join(folder, SHARDS_FOLDER, kind, name))
+    stamp[kind] = counts
+    with replacing(os.path.join(folder, SHARDS_STAMP), newline="", encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(SHARDS_HEADER)
+        for name in sorted(stamp):
+            for shard in sorted(stamp[name]):
+                writer.writerow([name, shard, stamp[name][shard]])
+
+
+def group_by_shard(ids, shards=None):
+    '''
+    Agrupa `ids` por shard (dict shard -> lista de ids). Se `shards` é
+    fornecido, ignora ids de outros shards.
+    '''
+    groups = {}
+    for id in ids:
+        shard = note_shard(id)
+        if shards is None or shard in shards:
+            groups.setdefault(shard, []).append(id)
+    return groups
+
+
+@measured("write_index_shards")
+def write_index_shards(index, folder, full=False):
+    '''
+    Grava shards do índice de notas alterados desde a última gravação
+    (`index.touched`); com `full` = True (ou se ainda não há shards), todos.
+    '''
+    bump_generation()
+    full = full or not has_shards(folder, "index")
+    if full:
+        groups = group_by_shard(index.records)
+    else:
+        groups = group_by_shard(index.records, set(note_shard(id) for id in index.touched))
+        for id in index.touched:
+            groups.setdefault(note_shard(id), [])
+    write_shards(folder, "index", groups, lambda shard: index.rows(groups[shard]), full)
+    index.touched.clear()
+
+
+@measured("write_link_shards")
+def write_link_shards(linklist, folder, full=False):
+    '''
+    Grava shards de links (pela nota de origem) e de backlinks (pela nota de
+    destino) alterados desde a última gravação; com `full` = True (ou se
+    ainda não há shards), todos.
+    '''
+    bump_generation()
+    full = full or not has_shards(folder, "links") or not has_shards(folder, "backlinks")
+    if full:
+        sources = group_by_shard(linklist.sources)
+        targets = group_by_shard(linklist.targets)
+    else:
+        sources = group_by_shard(linklist.sources, set(note_shard(id) for id in linklist.touched_sources))
+        for id in linklist.touched_sources:
+            sources.setdefault(note_shard(id), [])
+        targets = group_by_shard(linklist.targets, set(note_shard(id) for id in linklist.touched_targets))
+        for id in linklist.touched_targets:
+            targets.setdefault(note_shard(id), [])
+    write_shards(folder, "links", sources, lambda shard: linklist.rows(sources[shard]), full)
+    write_shards(folder, "backlinks", targets, lambda shard: linklist.backlink_rows(targets[shard]), full)
+    linklist.touched_sources.clear()
+    linklist.touched_targets.clear()
+
+
+def read_shard_rows(folder, kind, shards=None):
+    '''
+    Lê linhas (sem header) dos shards de `kind` (todos, ou só os em `shards`)
+    '''
+    stamp = read_shard_stamp(folder) or {}
+    rows = []
+    for shard in sorted(stamp.get(kind, {})):
+        if shards is not None and shard not in shards:
+            continue
+        with open(shard_path(folder, kind, shard), 'r', encoding='utf-8') as file:
+            rows.extend(islice(csv.reader(file), 1, None))
+    return rows
+
+
+@measured("read_index_shards")
+def read_index_shards(folder, shards=None):
+    '''
+    Lê shards do índice de notas (todos, ou só os em `shards`) e retorna NoteIndex
+    '''
+    rows = read_shard_rows(folder, "index", shards)
+    rows.insert(0, INDEX_HEADER)
+    return NoteIndex.from_rows(rows)
+
+
+@measured("read_link_shards")
+def read_link_shards(folder):
+    '''
+    Lê shards de links e retorna LinkTable
+    '''
+    rows = read_shard_rows(folder, "links")
+    rows.insert(0, LINKS_HEADER)
+    return LinkTable.from_rows(rows)
+
+
+def read_shard_tags(folder):
+    '''
+    Como `read_tags`, a partir dos shards do índice de notas
+    '''
+    return tags_from_rows(read_index_shards(folder).tag_rows())
+
+
+def shard_note_title(folder, id):
+    '''
+    Retorna título da nota com o id fornecido (ou None), lendo só o shard da nota
+    '''
+    record = read_index_shards(folder, [note_shard(id)]).get(id)
+    if record is None:
+        return None
+    return record.title
+
+
+def shard_notes_by_link(folder, id):
+    '''
+    Retorna lista "id fromtitle" das notas que linkam para o id fornecido,
+    lendo só o shard de backlinks da nota
+    '''
+    return [source + " " + fromtitle for target, source, fromtitle
+            in read_shard_rows(folder, "backlinks", [note_shard(id)]) if target == id]
+
+
+def export_flat(folder):
+    '''
+    Exporta shards para os arquivos únicos (`.index.zkdata`, `.tags.zkdata`,
+    `.links.zkdata` e `.backlinks.zkdata`), lidos pelo app em R
+    '''
+    with index_lock(folder):
+        write_index(read_index_shards(folder), folder)
+        write_links(read_link_shards(folder), folder)
+
+
+# ----------------------------------------------------------
+# Índice binário
+# ----------------------------------------------------------
+
+# Cópia do índice de notas em formato binário (`.index.zkbin`), gravada
+# junto com `.index.zkdata`, para consultas sem ler o CSV inteiro: o
+# arquivo é mapeado em memória (mmap) e cada nota é encontrada por busca
+# binária, sem criar objetos para as demais. Layout:
+#   header    BINARY_HEADER: assinatura e número de notas
+#   registros BINARY_RECORD por nota, ordenados pelo id (bytes em UTF-8):
+#             posição no heap, tamanho do id, do título e das tags; modified
+#   ordem     uint32 por nota: posição do registro, das notas mais recentes
+#             para as mais antigas (ordem de `.index.zkdata`)
+#   heap      id, título e tags de cada nota em sequência (UTF-8)
+BINARY_FILE = ".index.zkbin"
+BINARY_MAGIC = b"WMZKBIN1"
+BINARY_HEADER = struct.Struct("<8sI")
+BINARY_RECORD = struct.Struct("<IIIId")
+BINARY_POSITION = struct.Struct("<I")
+
+
+@measured("write_binary_index")
+def write_binary_index(index, folder):
+    '''
+    Grava NoteIndex em `.index.zkbin` (em arquivo temporário depois
+    renomeado, para que leitores nunca vejam o arquivo pela metade)
+    '''
+    records = sorted(index.records.values(), key=lambda record: record.id.encode("utf8"))
+    heap = bytearray()
+    table = bytearray()
+    for record in records:
+        id, title, tags = (value.encode("utf8") for value in (record.id, record.title, record.tags))
+        table += BINARY_RECORD.pack(len(heap), len(id), len(title), len(tags), record.modified)
+        heap += id + title + tags
+    order = sorted(range(len(records)), key=lambda position: records[position].modified, reverse=True)
+    with replacing(os.path.join(folder, BINARY_FILE), "wb") as file:
+        file.write(BINARY_HEADER.pack(BINARY_MAGIC, len(records)))
+        file.write(table)
+        file.write(struct.pack("<%dI" % len(order), *order))
+        file.write(heap)
+
+
+class BinaryIndex(object):
+    '''
+    Leitor de `.index.zkbin`. Consultas por id são O(log n) e só decodificam
+    as notas encontradas. Deve ser fechado depois do uso (`close` ou `with`),
+    para não manter o arquivo aberto enquanto o índice é regravado.
+    '''
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # arquivo vazio não pode ser mapeado
+            self.file.close()
+            raise ValueError("Índice binário inválido: " + filename)
+        magic, self.count = BINARY_HEADER.unpack_from(self.data, 0)
+        if magic != BINARY_MAGIC:
+            self.close()
+            raise ValueError("Índice binário inválido: " + filename)
+        self.order_start = BINARY_HEADER.size + self.count * BINARY_RECORD.size
+        self.heap_start = self.order_start + self.count * BINARY_POSITION.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, id):
+        return self.find(id) is not None
+
+    def entry(self, position):
+        return BINARY_RECORD.unpack_from(self.data, BINARY_HEADER.size + position * BINARY_RECORD.size)
+
+    def key(self, position):
+        offset, id_size = self.entry(position)[:2]
+        start = self.heap_start + offset
+        return self.data[start:start + id_size]
+
+    def find(self, id):
+        '''
+        Posição do registro da nota com o id fornecido (busca binária), ou None
+        '''
+        key = id.encode("utf8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.key(low) == key:
+            return low
+        return None
+
+    def record(self, position):
+        offset, id_size, title_size, tags_size, modified = self.entry(position)
+        start = self.heap_start + offset
+        title_start = start + id_size
+        tags_start = title_start + title_size
+        return NoteRecord(self.data[start:title_start].decode("utf8"),
+                          self.data[title_start:tags_start].decode("utf8"),
+                          self.data[tags_start:tags_start + tags_size].decode("utf8"), modified)
+
+    def get(self, id):
+        position = self.find(id)
+        if position is None:
+            return None
+        return self.record(position)
+
+    def title(self, id):
+        '''
+        Título da nota com o id fornecido (ou None), sem decodificar id e tags
+        '''
+        position = self.find(id)
+        if position is None:
+            return None
+        offset, id_size, title_size = self.entry(position)[:3]
+        start = self.heap_start + offset + id_size
+        return self.data[start:start + title_size].decode("utf8")
+
+    def recent(self):
+        '''
+        Itera pelas notas, das mais recentes para as mais antigas
+        '''
+        for (position,) in BINARY_POSITION.iter_unpack(self.data[self.order_start:self.heap_start]):
+            yield self.record(position)
+
+
+@measured("binary_note_title")
+def binary_note_title(folder, id):
+    '''
+    Retorna título da nota com o id fornecido (ou None) do índice binário
+    '''
+    with BinaryIndex(os.path.join(folder, BINARY_FILE)) as index:
+        return index.title(id)
+
+
+@measured("binary_note_list")
+def binary_note_list(folder):
+    '''
+    Retorna lista "id título" das notas, das mais recentes para as mais
+    antigas, do índice binário
+    '''
+    with BinaryIndex(os.path.join(folder, BINARY_FILE)) as index:
+        return [record.id + " " + record.title for record in index.recent()]
+
+
+# ----------------------------------------------------------
+# Funções de atualização
+# ----------------------------------------------------------
+
+def read_stored_index(folder, storage="csv"):
+    '''
+    Lê índice de notas do armazenamento configurado
+    (com "sqlite", usa o CSV se o banco ainda não existe)
+    '''
+    if storage == "sqlite" and has_db(folder, "notes"):
+        return read_db_index(folder)
+    if storage == "shards" and has_shards(folder, "index"):
+        return read_index_shards(folder)
+    return read_index(folder)
+
+
+def read_stored_links(folder, storage="csv"):
+    '''
+    Lê tabela de links do armazenamento configurado
+    (com "sqlite", usa o CSV se o banco ainda não existe)
+    '''
+    if storage == "sqlite" and has_db(folder, "links"):
+        return read_db_links(folder)
+    if storage == "shards" and has_shards(folder, "links"):
+        return read_link_shards(folder)
+    return read_links(folder)
+
+
+def write_stored_index(index, index_folder, notes_folder, storage="csv", rebuild=False):
+    '''
+    Grava índice de notas (CSV ou, com "shards", só os shards alterados)
+    e o índice para o Android
+    '''
+    if storage == "shards":
+        write_index_shards(index, index_folder, rebuild)
+        rows = index.recent_rows(10)
+    else:
+        rows = write_index(index, index_folder)
+    index_android(rows, notes_folder)
+
+
+def write_stored_links(linklist, index_folder, storage="csv", rebuild=False):
+    '''
+    Grava lista de links (CSV ou, com "shards", só os shards alterados)
+    '''
+    if storage == "shards":
+        write_link_shards(linklist, index_folder, rebuild)
+    else:
+        write_links(linklist, index_folder)
+
+
+def index_exists(folder, storage="csv"):
+    '''
+    Checa se o índice de notas já foi criado em `folder`
+    '''
+    if storage == "shards" and has_shards(folder, "index"):
+        return True
+    return os.path.exists(os.path.join(folder, ".index.zkdata"))
+
+
+def missing_shards(folder, storage, kind):
+    '''
+    Checa se, com `storage` = "shards", os shards de `kind` ainda precisam
+    ser criados (ex.: primeira atualização depois de mudar de "csv")
+    '''
+    return storage == "shards" and not has_shards(folder, kind)
+
+
+@locked
+@measured("update_index")
+def update_index(notes_folder = None, index_folder = None, rebuild = False, get_body_tags = False, storage = "csv",
+                 workers = None, chunksize = PARALLEL_CHUNKSIZE):
+    '''
+    Atualiza `.index.zkdata` com as notas acrescentadas ou modificadas desde
+    a última atualização e remove as notas apagadas.
+    Com `storage` = "sqlite", grava também o banco `.index.zkdb` (o CSV
+    continua sendo exportado para o app em R).
+    Muitas notas (ex.: `rebuild` = True) são lidas em paralelo por `workers`
+    processos (None = todos os processadores; 1 = sempre em série).
+    '''
+    started = time.time()
+    manifest, added, modified, deleted = get_changed_notes(notes_folder, index_folder, "index", rebuild)
+    if rebuild:
+        index = NoteIndex()
+    else:
+        index = read_stored_index(index_folder, storage)
+    count_new = 0
+    count_updated = 0
+    removed = []
+    changed_ids = []
+    changed = added + modified
+    if len(changed) > 0:
+        result, changed_ids, replaced = read_changed_notes(notes_folder, manifest, changed,
+                                                           get_notes_metadata, index, get_body_tags,
+                                                           workers=workers, chunksize=chunksize)
+        index, count_new, count_updated = result
+        deleted = deleted + replaced
+    for id in get_removed_ids(manifest, deleted):
+        if index.remove(id):
+            removed.append(id)
+    count_deleted = len(removed)
+    if storage == "sqlite":
+        if rebuild or not has_db(index_folder, "notes"):
+            write_db_index(index, index_folder)
+        elif len(changed_ids) > 0 or count_deleted > 0:
+            write_db_index(index, index_folder, changed_ids, removed)
+    if count_new > 0 or count_updated > 0 or count_deleted > 0 or missing_shards(index_folder, storage, "index"):
+        write_stored_index(index, index_folder, notes_folder, storage, rebuild)
+    write_manifest(manifest, index_folder, "index")
+    log(index_folder, count_new, count_updated, count_deleted=count_deleted, now=started)
+
+
+
+@locked
+@measured("update_links")
+def update_links(notes_folder, index_folder, rebuild = False, storage = "csv",
+                 workers = None, chunksize = PARALLEL_CHUNKSIZE):
+    '''
+    Atualiza `.links.zkdata` com os links das notas acrescentadas ou
+    modificadas desde a última atualização e remove os links de saída
+    das notas apagadas.
+    Com `storage` = "sqlite", grava também o banco `.index.zkdb` (o CSV
+    continua sendo exportado para o app em R).
+    Muitas notas (ex.: `rebuild` = True) são lidas em paralelo por `workers`
+    processos (None = todos os processadores; 1 = sempre em série).
+    '''
+    started = time.time()
+    manifest, added, modified, deleted = get_changed_notes(notes_folder, index_folder, "links", rebuild)
+    if rebuild:
+        linklist = LinkTable()
+    else:
+        linklist = read_stored_links(index_folder, storage)
+    changed_ids = []
+    changed = added + modified
+    if len(changed) > 0:
+        linklist, changed_ids, replaced = read_changed_notes(notes_folder, manifest, changed, get_links, linklist,
+                                                             workers=workers, chunksize=chunksize)
+        deleted = deleted + replaced
+    removed = get_removed_ids(manifest, deleted)
+    for id in removed:
+        linklist.remove(id)
+    if storage == "sqlite":
+        if rebuild or not has_db(index_folder, "links"):
+            write_db_links(linklist, index_folder)
+        elif len(changed_ids) > 0 or len(removed) > 0:
+            write_db_links(linklist, index_folder, changed_ids + removed)
+    if len(changed_ids) > 0 or len(removed) > 0 or missing_shards(index_folder, storage, "links"):
+        write_stored_links(linklist, index_folder, storage, rebuild)
+    write_manifest(manifest, index_folder, "links")
+    log(index_folder, 0, 0, True, now=started)
+
+
+
+# Índices mantidos por update_all (cada um com seu manifesto e timestamp)
+UPDATE_ALL_TARGETS = ["index", "links", "search"]
+
+
+@locked
+@measured("update_all")
+def update_all(notes_folder, index_folder, rebuild = False, storage = "csv",
+               workers = None, chunksize = PARALLEL_CHUNKSIZE):
+    '''
+    Atualiza índice de notas (com tags do corpo das notas), lista de links
+    e índice de busca numa única passada: percorre a pasta de notas uma vez
+    e lê cada nota modificada uma única vez.
+    Muitas notas (ex.: `rebuild` = True) são lidas em paralelo por `workers`
+    processos (None = todos os processadores; 1 = sempre em série).
+    '''
+    started = time.time()
+    scan = scan_notes(notes_folder)
+    manifests = {}
+    deleted = {}
+    # caminhos modificados desde a última atualização de cada índice
+    pending = {}
+    for name in UPDATE_ALL_TARGETS:
+        manifest, added, modified, deleted[name] = get_changed_notes(
+            notes_folder, index_folder, name, rebuild, scan)
+        manifests[name] = manifest
+        pending[name] = set(added + modified)
+    # Notas modificadas desde a última atualização de algum dos índices
+    changed = sorted(set().union(*pending.values()))
+    # ids das notas efetivamente relidas, por índice
+    changed_ids = dict((name, []) for name in UPDATE_ALL_TARGETS)
+    # Hash anterior só é usado se a nota tem o mesmo hash em todos os manifestos
+    hashes = []
+    for path in changed:
+        found = set(manifests[name][path][4] for name in UPDATE_ALL_TARGETS)
+        hashes.append(found.pop() if len(found) == 1 else None)
+    notes = read_notes([os.path.join(notes_folder, path) for path in changed], True, workers, chunksize,
+                       hashes, terms=True)
+    parsed = []
+    for path, note in zip(changed, notes):
+        if note is None:
+            continue
+        for name, manifest in manifests.items():
+            # id alterado no front matter: o anterior é removido como o de
+            # uma nota apagada
+            if manifest[path][3] not in ("", note.id):
+                deleted[name].append(manifest[path][3])
+            manifest[path][3] = note.id
+            manifest[path][4] = note.hash
+            if path in pending[name]:
+                changed_ids[name].append(note.id)
+        parsed.append((path, note))
+    removed_ids = dict((name, get_removed_ids(manifests[name], deleted[name])) for name in UPDATE_ALL_TARGETS)
+    # Cada índice só é lido (e gravado) se alguma nota dele mudou
+    index_changed = (rebuild or len(changed_ids["index"]) > 0 or len(removed_ids["index"]) > 0
+                    or missing_shards(index_folder, storage, "index")
+                    or (storage == "sqlite" and not has_db(index_folder, "notes")))
+    links_changed = (rebuild or len(changed_ids["links"]) > 0 or len(removed_ids["links"]) > 0
+                    or missing_shards(index_folder, storage, "links")
+                    or (storage == "sqlite" and not has_db(index_folder, "links")))
+    search_ids = changed_ids["search"] + removed_ids["search"]
+    # Sem shards (índice ainda não existe ou no formato antigo), lê e grava tudo
+    search_shards = None if read_search_stamp(index_folder) is None else set(map(note_shard, search_ids))
+    search_changed = rebuild or len(search_ids) > 0 or search_shards is None
+    count_new = 0
+    count_updated = 0
+    removed = []
+    if index_changed:
+        index = NoteIndex() if rebuild else read_stored_index(index_folder, storage)
+        for path, note in parsed:
+            if index.upsert(note.id, note.title, ";".join(note.tags), note.modified):
+                count_new += 1
+            elif path in pending["index"]:
+                count_updated += 1
+        for id in removed_ids["index"]:
+            if index.remove(id):
+                removed.append(id)
+        if storage == "sqlite":
+            if rebuild or not has_db(index_folder, "notes"):
+                write_db_index(index, index_folder)
+            else:
+                write_db_index(index, index_folder, changed_ids["index"], removed)
+        write_stored_index(index, index_folder, notes_folder, storage, rebuild)
+    if links_changed:
+        linklist = LinkTable() if rebuild else read_stored_links(index_folder, storage)
+        for path, note in parsed:
+            linklist.replace(note.id, note.title, note.links)
+        for id in removed_ids["links"]:
+            linklist.remove(id)
+        if storage == "sqlite":
+            if rebuild or not has_db(index_folder, "links"):
+                write_db_links(linklist, index_folder)
+            else:
+                write_db_links(linklist, index_folder, changed_ids["links"] + removed_ids["links"])
+        write_stored_links(linklist, index_folder, storage, rebuild)
+    if search_changed:
+        search = SearchIndex() if rebuild else read_search_index(index_folder, search_shards)
+        for path, note in parsed:
+            if rebuild or path in pending["search"]:
+                search.set_note(note.id, note.terms)
+        for id in removed_ids["search"]:
+            search.remove(id)
+        write_search_index(search, index_folder, rebuild)
+    for name in UPDATE_ALL_TARGETS:
+        write_manifest(manifests[name], index_folder, name)
+    log(index_folder, count_new, count_updated, count_deleted=len(removed), now=started)
+    log(index_folder, 0, 0, True, now=started)
+    write_timestamp(index_folder, "search", started)
+
+
+@locked
+@measured("update_note")
+def update_note(notes_folder, index_folder, file, storage = "csv", index = None, linklist = None, search = None):
+    '''
+    Atualiza índice de notas, lista de links e índice de busca com uma única
+    nota `file` (ex.: logo depois de salva), lendo apenas esse arquivo, sem
+    percorrer a pasta de notas. Os manifestos também são atualizados, para
+    que a próxima atualização completa não leia a nota de novo.
+    `index`, `linklist` e `search` (ex.: em cache no plugin) não são
+    alterados: são atualizadas cópias deles, para que outras threads possam
+    continuar lendo os originais; os que não forem fornecidos são lidos do
+    disco (do índice de busca, só os shards da nota).
+    Se algum dos índices ainda não existe, faz `update_all`.
+    Retorna (index, linklist, search), ou None se nada mudou (`search` lido
+    do disco aqui tem só os shards da nota).
+    '''
+    path = os.path.relpath(file, notes_folder)
+    if path.startswith(os.pardir) or not path.endswith(NOTE_EXTENSION):
+        return None
+    manifests = OrderedDict((name, read_manifest(index_folder, name)) for name in UPDATE_ALL_TARGETS)
+    if any(manifest is None for manifest in manifests.values()):
+        update_all(notes_folder, index_folder, not index_exists(index_folder, storage), storage, 1)
+        return None
+    status = note_status(file)
+    previous = [manifest.get(path) for manifest in manifests.values()]
+    # Hash anterior só é usado se a nota tem o mesmo hash em todos os manifestos
+    found = set(entry[4] if entry is not None else None for entry in previous)
+    note = parse_note(file, True, found.pop() if len(found) == 1 else None, terms=True)
+    if note is None:
+        # conteúdo não mudou (só mtime)
+        for name, manifest in manifests.items():
+            manifest[path][:3] = list(status)
+            write_manifest(manifest, index_folder, name)
+        return None
+    # id anterior deste arquivo (ex.: id alterado no front matter)
+    old_ids = [entry[3] for entry in previous if entry is not None and entry[3] not in ("", note.id)]
+    for manifest in manifests.values():
+        manifest[path] = list(status) + [note.id, note.hash]
+    removed = get_removed_ids(manifests["index"], old_ids)
+    if index is None:
+        index = read_stored_index(index_folder, storage)
+    else:
+        index = index.copy()
+    if linklist is None:
+        linklist = read_stored_links(index_folder, storage)
+    else:
+        linklist = linklist.copy()
+    if search is None:
+        search = read_search_index(index_folder, set(map(note_shard, [note.id] + removed)))
+    else:
+        search = search.copy()
+    for id in removed:
+        index.remove(id)
+        linklist.remove(id)
+        search.remove(id)
+    created = index.upsert(note.id, note.title, ";".join(note.tags), note.modified)
+    linklist.replace(note.id, note.title, note.links)
+    search.set_note(note.id, note.terms)
+    if storage == "sqlite":
+        if has_db(index_folder, "notes"):
+            write_db_index(index, index_folder, [note.id], removed)
+        if has_db(index_folder, "links"):
+            write_db_links(linklist, index_folder, [note.id] + removed)
+    write_stored_index(index, index_folder, notes_folder, storage)
+    write_stored_links(linklist, index_folder, storage)
+    write_search_index(search, index_folder)
+    for name, manifest in manifests.items():
+        write_manifest(manifest, index_folder, name)
+    print(time.strftime("%Y-%m-%d %H:%M:%S - ") + ("Nota nova: " if created else "Nota atualizada: ") + note.id)
+    return index, linklist, search
+
+
+
+# ----------------------------------------------------------
+# Observador da pasta de notas
+# ----------------------------------------------------------
+
+class PollingWatcher(object):
+    '''
+    Detecta alterações em notas comparando `scan_notes` (mtime, size, inode)
+    a cada consulta. Funciona em qualquer sistema.
+    '''
+    def __init__(self, folder):
+        self.folder = folder
+        self.scan = scan_notes(folder)
+
+    def wait(self, timeout):
+        '''
+        Espera `timeout` segundos e retorna True se alguma nota foi
+        acrescentada, modificada ou removida
+        '''
+        time.sleep(timeout)
+        scan = scan_notes(self.folder)
+        changed = scan != self.scan
+        self.scan = scan
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    '''
+    Recebe eventos de alteração de notas do kernel (inotify, só Linux),
+    sem percorrer a pasta. Subpastas (exceto as ocultas) também são
+    observadas, inclusive as criadas depois.
+    '''
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_ISDIR = 0x40000000
+    MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+            IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, folder):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.folders = {}
+        self.add_folder(folder)
+
+    def add_folder(self, folder):
+        '''
+        Observa `folder` e suas subpastas (exceto as ocultas)
+        '''
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK)
+        if wd < 0:
+            return
+        self.folders[wd] = folder
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir() and not entry.name.startswith("."):
+                    self.add_folder(entry.path)
+
+    def wait(self, timeout):
+        '''
+        Espera até `timeout` segundos por eventos e retorna True se algum
+        se refere a uma nota (ou a uma pasta)
+        '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        data = os.read(self.fd, 64 * 1024)
+        changed = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode("utf8", "replace")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                # eventos perdidos: a atualização percorre a pasta de qualquer forma
+                changed = True
+            elif mask & self.IN_ISDIR:
+                if name.startswith("."):
+                    continue
+                changed = True
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and wd in self.folders:
+                    self.add_folder(os.path.join(self.folders[wd], name))
+            elif mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                changed = True
+                self.folders.pop(wd, None)
+            elif name.endswith(NOTE_EXTENSION):
+                changed = True
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(folder, polling=False):
+    '''
+    Retorna InotifyWatcher no Linux; em outros sistemas (ou se inotify
+    não está disponível, ou `polling` = True), PollingWatcher
+    '''
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(folder)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(folder)
+
+
+def watch(notes_folder, index_folder, storage = "csv", workers = None, chunksize = PARALLEL_CHUNKSIZE,
+          delay = 2.0, interval = 5.0, polling = False):
+    '''
+    Mantém índices atualizados continuamente (para alterações feitas fora
+    do Sublime: sincronização, git, scripts etc.).
+    Espera por alterações (consultando a cada `interval` segundos) e, ao
+    detectar alguma, espera até que a pasta fique `delay` segundos sem
+    alterações, para juntar vários eventos numa única atualização
+    (`update_all`, que só lê as notas alteradas).
+    '''
+    watcher = make_watcher(notes_folder, polling)
+    print("Observando %s (%s)" % (notes_folder, watcher.__class__.__name__))
+    try:
+        update_all(notes_folder, index_folder, not index_exists(index_folder, storage), storage, workers, chunksize)
+        while True:
+            if not watcher.wait(interval):
+                continue
+            while watcher.wait(delay):
+                pass
+            update_all(notes_folder, index_folder, False, storage, workers, chunksize)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Mantém índice de notas e links do wmZk")
+    parser.add_argument("command", choices=["update", "rebuild", "watch", "report", "export"])
+    parser.add_argument("notes_folder")
+    parser.add_argument("index_folder")
+    parser.add_argument("--storage", default="csv", choices=["csv", "sqlite", "shards"])
+    parser.add_argument("--workers", type=int, default=None,
+                        help="número de processos (default: todos os processadores)")
+    parser.add_argument("--chunksize", type=int, default=PARALLEL_CHUNKSIZE)
+    parser.add_argument("--delay", type=float, default=2.0,
+                        help="watch: segundos sem alterações antes de atualizar")
+    parser.add_argument("--interval", type=float, default=5.0,
+                        help="watch: intervalo entre consultas à pasta de notas")
+    parser.add_argument("--polling", action="store_true",
+                        help="watch: percorre a pasta em vez de usar inotify")
+    parser.add_argument("--metrics", action="store_true",
+                        help="grava tempos das operações em .zkmetrics.txt na pasta do índice")
+    args = parser.parse_args()
+    if args.metrics:
+        enable_metrics(args.index_folder)
+    if args.command == "report":
+        print(performance_report(args.index_folder))
+        sys.exit(0)
+    if args.command == "export":
+        export_flat(args.index_folder)
+        sys.exit(0)
+    if args.command == "watch":
+        watch(args.notes_folder, args.index_folder, args.storage, args.workers, args.chunksize,
+              args.delay, args.interval, args.polling)
+        sys.exit(0)
+    update_all(args.notes_folder, args.index_folder, args.command == "rebuild",
+               args.storage, args.workers, args.chunksize)